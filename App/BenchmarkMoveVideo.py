@@ -0,0 +1,188 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+# Synthetic benchmark of MoveVideo: builds in/ and out*/ trees in a temporary directory and times every
+# phase separately. Run from any directory:
+#   python3 BenchmarkMoveVideo.py --files 20000 --directories 8000 --output result.json
+
+
+def make_key(rnd: random.Random) -> str:
+    return "".join(rnd.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ") for _ in range(rnd.randint(4, 10)))
+
+
+def create_file(path: str, size: int):
+    # Sparse file: the size is right but no data is written
+    with open(path, "wb") as f:
+        f.truncate(size)
+
+
+def generate_tree(base: str, args):
+    rnd = random.Random(args.seed)
+    os.makedirs(os.path.join(base, "in"))
+    os.makedirs(os.path.join(base, "library"))
+    os.makedirs(os.path.join(base, "config"))
+    with open(os.path.join(base, "config", "config.toml"), "w") as f:
+        f.write("[MoveVideo]\n")
+        f.write(f"IndexCache = {'config/destination_index.sqlite' if args.cache else ''}\n")
+        f.write(f"MoveConcurrency = {args.concurrency}\n")
+        # The synthetic files have just been written
+        f.write("StableSeconds = 0\n")
+        # The sparse files are all zeros: every file of a directory would be a duplicate of the first one
+        f.write("DuplicateCheck = false\n")
+
+    roots = ["out"] + [f"out{i}" for i in range(1, args.roots)]
+    for root in roots:
+        os.makedirs(os.path.join(base, root))
+
+    keys = list()
+    for i in range(args.directories):
+        key = make_key(rnd)
+        alias = make_key(rnd)
+        keys.append(key)
+        name = f"{key}.{alias}"
+        root = os.path.join(base, rnd.choice(roots))
+        if i < args.symlinks:
+            # Destination directory living outside of the out* roots, reached through a symlink
+            target = os.path.join(base, "library", name)
+            os.makedirs(target, exist_ok=True)
+            os.symlink(target, os.path.join(root, name))
+        else:
+            os.makedirs(os.path.join(root, name), exist_ok=True)
+
+    inbox = os.path.join(base, "in")
+    for i in range(args.files):
+        if rnd.random() < args.unmatched:
+            key = make_key(rnd)
+        else:
+            key = rnd.choice(keys)
+            if rnd.random() < args.typos:
+                # Misspelled key: no exact match, found by the fuzzy matcher only
+                position = rnd.randrange(len(key))
+                key = key[:position] + rnd.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ") + key[position + 1:]
+        directory = inbox
+        for _ in range(rnd.randint(0, args.depth)):
+            directory = os.path.join(directory, f"d{rnd.randint(0, 20)}")
+        os.makedirs(directory, exist_ok=True)
+        extension = rnd.choice([".mkv", ".mp4", ".avi", ".MKV"])
+        create_file(os.path.join(directory, f"{key}.S01E{i:05d}{extension}"), args.size)
+
+    for i in range(args.junk):
+        directory = os.path.join(inbox, f"junk{i}")
+        for level in range(rnd.randint(1, args.depth + 1)):
+            directory = os.path.join(directory, f"sub{level}")
+        os.makedirs(directory, exist_ok=True)
+        create_file(os.path.join(directory, "info.nfo"), rnd.randint(10, 500))
+        create_file(os.path.join(directory, "sample.txt"), rnd.randint(10, 500))
+
+
+def timed(timings: dict, name: str, function, *args):
+    # Phases called once per root are summed
+    start = time.perf_counter()
+    result = function(*args)
+    timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+    return result
+
+
+def run_once(args, counts: dict, timings: dict):
+    base = tempfile.mkdtemp(prefix="movevideo-bench-", dir=args.tmpdir)
+    cwd = os.getcwd()
+    try:
+        generate_tree(base, args)
+        os.chdir(base)
+        # MoveVideo checks its directories at import time, so it is imported inside the synthetic tree
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import MoveVideo
+
+        move_video = MoveVideo.MoveVideo()
+        move_video.logger.logger.setLevel(logging.WARNING)
+        output_dirs = move_video.get_output_dirs()
+
+        sources = timed(timings, "generate_source_list", move_video.generate_source_list)
+        destinations = dict()
+        for output_dir in output_dirs:
+            destinations.update(timed(timings, "generate_destination_list", move_video.generate_destination_list,
+                                      output_dir))
+        if args.cache:
+            # First call fills the on-disk cache, the second one is served from it
+            for output_dir in output_dirs:
+                timed(timings, "get_destination_index_cold", move_video.get_destination_index, output_dir)
+            for output_dir in output_dirs:
+                timed(timings, "get_destination_index_cached", move_video.get_destination_index, output_dir)
+        unmatched = [source for source in sources if source.Key not in destinations]
+        matcher = timed(timings, "fuzzy_index", move_video.get_fuzzy_matcher, destinations)
+        timed(timings, "fuzzy_match", lambda: [matcher.match(source.File, move_video.extract_key_from_filename)
+                                               for source in unmatched])
+        if unmatched and args.max_fuzzy_ms is not None:
+            per_match = timings["fuzzy_match"] / len(unmatched) * 1000
+            if per_match > args.max_fuzzy_ms:
+                raise Exception(f"Fuzzy match took {per_match:.2f} ms per file, more than {args.max_fuzzy_ms} ms")
+        timed(timings, "move_files", move_video.move_files, output_dirs)
+        deleted = timed(timings, "delete_small_directories", move_video.delete_small_directories,
+                        MoveVideo.DIR_IN)
+
+        counts["sources"] = len(sources)
+        counts["destination_keys"] = len(destinations)
+        counts["fuzzy_matched_sources"] = len(unmatched)
+        counts["remaining_sources"] = len(move_video.generate_source_list())
+        counts["deleted_directories"] = len(deleted)
+    finally:
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(base, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark MoveVideo on a synthetic in/out* tree')
+    parser.add_argument('--files', type=int, default=5000, help='Video files in the inbox')
+    parser.add_argument('--directories', type=int, default=2000, help='Series directories in the out* roots')
+    parser.add_argument('--symlinks', type=int, default=200, help='Series directories reached through a symlink')
+    parser.add_argument('--junk', type=int, default=500, help='Nested directories with small non video files')
+    parser.add_argument('--roots', type=int, default=3, help='Number of out* roots')
+    parser.add_argument('--depth', type=int, default=3, help='Maximum nesting of the inbox directories')
+    parser.add_argument('--size', type=int, default=1024 * 1024, help='Size of every video file (sparse)')
+    parser.add_argument('--unmatched', type=float, default=0.1, help='Fraction of files without a destination')
+    parser.add_argument('--typos', type=float, default=0.05, help='Fraction of files with a misspelled key')
+    parser.add_argument('--max_fuzzy_ms', type=float, default=2.0,
+                        help='Fail when a fuzzy match takes longer than this on average')
+    parser.add_argument('--concurrency', type=int, default=2, help='MoveConcurrency used by the mover')
+    parser.add_argument('--cache', action='store_true', help='Enable the on-disk destination index cache')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs, each on a fresh tree')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--tmpdir', type=str, default=None, help='Where the synthetic trees are created')
+    parser.add_argument('--keep', action='store_true', help='Do not delete the synthetic tree')
+    parser.add_argument('--output', type=str, default=None, help='Write the JSON report to this file')
+    args = parser.parse_args()
+
+    counts: dict = dict()
+    runs = list()
+    for _ in range(max(1, args.repeat)):
+        timings: dict = dict()
+        run_once(args, counts, timings)
+        runs.append(timings)
+
+    import MoveVideo
+    report = {
+        "version": MoveVideo.VERSION,
+        "python": platform.python_version(),
+        "parameters": vars(args),
+        "counts": counts,
+        "timings": {name: {"best": min(run[name] for run in runs),
+                           "mean": sum(run[name] for run in runs) / len(runs)} for name in runs[0]}
+    }
+    result = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(result)
+    print(result)
+
+
+if __name__ == '__main__':
+    main()
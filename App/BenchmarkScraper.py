@@ -0,0 +1,62 @@
+import argparse
+import glob
+import json
+import os
+import platform
+import time
+
+from ProxiedScraper import Scraper
+
+# Benchmark of the ProxiedScraper table extraction on saved pages: the streaming parser (Scraper.parse) is
+# compared with BeautifulSoup (Scraper.parse_soup), checking that both return the same links.
+#   python3 BenchmarkScraper.py --repeat 50 --output result.json
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', '*.html')
+
+
+def best_time(function, html: str, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(html)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the ProxiedScraper table extraction on saved pages')
+    parser.add_argument('--pages', type=str, default=FIXTURES, help='Glob of the saved HTML pages')
+    parser.add_argument('--column_magnet', type=int, default=2)
+    parser.add_argument('--column_title', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=20, help='Parses of every page, the best time is reported')
+    parser.add_argument('--output', type=str, default=None, help='Write the JSON report to this file')
+    args = parser.parse_args()
+
+    scraper = Scraper("", column_magnet_link=args.column_magnet, column_description=args.column_title)
+    pages = dict()
+    for path in sorted(glob.glob(args.pages)):
+        with open(path, encoding='utf-8') as f:
+            html = f.read()
+        links = scraper.parse(html)
+        if links != scraper.parse_soup(html):
+            raise Exception(f"Different links from the two parsers in {path}")
+        stream = best_time(scraper.parse, html, args.repeat)
+        soup = best_time(scraper.parse_soup, html, args.repeat)
+        pages[os.path.basename(path)] = {"bytes": len(html.encode('utf-8')), "links": len(links),
+                                         "stream": stream, "soup": soup, "speedup": soup / stream}
+
+    report = {
+        "python": platform.python_version(),
+        "parameters": vars(args),
+        "pages": pages
+    }
+    result = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(result)
+    print(result)
+
+
+if __name__ == '__main__':
+    main()
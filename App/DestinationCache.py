@@ -0,0 +1,53 @@
+import os
+import sqlite3
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+
+class DestinationIndexCache:
+    """
+    On-disk cache of the key -> destination directories index of every out* root.
+
+    Each root is stored with the mtime of its directory: adding, removing or renaming a
+    series directory changes that mtime, so only the roots that changed are rescanned.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS roots (root TEXT PRIMARY KEY, mtime_ns INTEGER)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries (root TEXT, position INTEGER, key TEXT, path TEXT)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS entries_root ON entries (root)")
+        self.connection.commit()
+
+    def load(self, root: str, build: Callable[[str], Dict[str, List[Path]]]) -> Tuple[Dict[str, List[Path]], bool]:
+        """
+        Returns the index of the root and True when it was read from the cache.
+        The index is rebuilt with "build" and stored when the root has changed since the last run.
+        """
+        root_key = os.path.abspath(root)
+        mtime_ns = os.stat(root).st_mtime_ns
+        row = self.connection.execute("SELECT mtime_ns FROM roots WHERE root = ?", (root_key,)).fetchone()
+        if row is not None and row[0] == mtime_ns:
+            index: Dict[str, List[Path]] = dict()
+            for key, path in self.connection.execute(
+                    "SELECT key, path FROM entries WHERE root = ? ORDER BY position", (root_key,)):
+                index.setdefault(key, []).append(Path(path))
+            return index, True
+
+        index = build(root)
+        self.store(root_key, mtime_ns, index)
+        return index, False
+
+    def store(self, root_key: str, mtime_ns: int, index: Dict[str, List[Path]]):
+        rows = [(root_key, position, key, str(path)) for position, (key, path) in
+                enumerate((key, path) for key, paths in index.items() for path in paths)]
+        with self.connection:
+            self.connection.execute("DELETE FROM entries WHERE root = ?", (root_key,))
+            self.connection.executemany("INSERT INTO entries (root, position, key, path) VALUES (?, ?, ?, ?)", rows)
+            self.connection.execute("INSERT OR REPLACE INTO roots (root, mtime_ns) VALUES (?, ?)",
+                                    (root_key, mtime_ns))
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,38 @@
+import os
+from typing import Set
+
+
+def files_open_for_writing(directory: str) -> Set[str]:
+    """
+    Real paths of the files under "directory" that some process has open for writing.
+
+    The open file descriptors are read from /proc/<pid>/fd and their mode from /proc/<pid>/fdinfo:
+    only the processes visible from this container (and readable by this user) are checked.
+    """
+    result: Set[str] = set()
+    root = os.path.realpath(directory) + os.sep
+    try:
+        pids = [pid for pid in os.listdir("/proc") if pid.isdigit()]
+    except OSError:
+        return result
+    for pid in pids:
+        fd_dir = f"/proc/{pid}/fd"
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                target = os.readlink(f"{fd_dir}/{fd}")
+                if not target.startswith(root):
+                    continue
+                with open(f"/proc/{pid}/fdinfo/{fd}") as f:
+                    for line in f:
+                        if line.startswith("flags:"):
+                            if int(line.split()[1], 8) & (os.O_WRONLY | os.O_RDWR):
+                                result.add(target)
+                            break
+            except (OSError, ValueError):
+                # Process or descriptor closed in the meantime
+                continue
+    return result
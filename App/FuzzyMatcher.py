@@ -0,0 +1,122 @@
+import re
+from collections import namedtuple
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+# Release group prefixes such as "[Group]", "(Group)" or "{Group}" at the beginning of a filename
+RELEASE_GROUP = re.compile(r'^\s*(\[[^\]]*\]|\([^)]*\)|\{[^}]*\})\s*')
+NOT_ALPHANUMERIC = re.compile(r'[\W_]+')
+TITLE_END = re.compile(r'\s+-\s+|[\[({]|\s\d')
+
+FuzzyMatch = namedtuple("FuzzyMatch", ["Key", "Confidence", "Distance"])
+
+
+def normalize_key(key: str) -> str:
+    # Ignore case, punctuation and spacing: "Show.Name", "show name" and "Show_Name" become "showname"
+    return NOT_ALPHANUMERIC.sub('', key.lower())
+
+
+def strip_release_group(filename: str) -> str:
+    previous = None
+    while previous != filename:
+        previous = filename
+        filename = RELEASE_GROUP.sub('', filename, count=1)
+    return filename
+
+
+def levenshtein(a: str, b: str, max_distance: int) -> int:
+    # Edit distance, or max_distance + 1 as soon as it is known to be above max_distance
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+
+def trigrams(key: str) -> Set[str]:
+    padded = f"  {key}  "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class FuzzyMatcher:
+    """
+    Approximate lookup of a filename among the destination keys.
+
+    Keys are compared after normalization (case, punctuation and spacing are ignored); the
+    remaining differences are found with a trigram index, so only keys sharing enough
+    trigrams with the candidate are compared with the bounded edit distance. Keys are
+    gathered from the rarest trigrams of the candidate only: the padded trigrams at the
+    edges ("  s", " sh") are shared by thousands of keys and are never scanned. With a
+    min_confidence the distance allowed for short keys is lowered too, since no match
+    below that confidence could be accepted anyway.
+    """
+
+    def __init__(self, keys: Iterable[str], max_distance: int = 2, min_confidence: float = 0.0):
+        self.max_distance = max_distance
+        self.min_confidence = min_confidence
+        self.keys: Dict[str, str] = dict()  # normalized key -> destination key
+        self.index: Dict[str, List[str]] = dict()  # trigram -> normalized keys
+        self.trigrams: Dict[str, Set[str]] = dict()  # normalized key -> trigrams
+        for key in keys:
+            normalized = normalize_key(key)
+            if normalized and normalized not in self.keys:
+                self.keys[normalized] = key
+                self.trigrams[normalized] = trigrams(normalized)
+                for trigram in self.trigrams[normalized]:
+                    self.index.setdefault(trigram, []).append(normalized)
+
+    def candidates(self, filename: str, extract_key: Callable[[str], str]) -> List[str]:
+        # The key as extracted today, the key without release group prefix and the title before the episode
+        stripped = strip_release_group(filename)
+        result = list()
+        for candidate in (extract_key(filename), extract_key(stripped), TITLE_END.split(stripped)[0]):
+            normalized = normalize_key(candidate)
+            if normalized and normalized not in result:
+                result.append(normalized)
+        return result
+
+    def lookup(self, candidate: str) -> Optional[FuzzyMatch]:
+        if candidate in self.keys:
+            return FuzzyMatch(self.keys[candidate], 1.0, 0)
+        # Every edit changes at most 3 trigrams, so a key within distance k shares all but 3k of the
+        # trigrams of the candidate: k is reduced for short keys so that the bound still filters
+        max_distance = min(self.max_distance, (len(candidate) + 1) // 3)
+        if self.min_confidence > 0:
+            # 1 - k / (len + k) >= min_confidence
+            max_distance = min(max_distance,
+                               int((1 - self.min_confidence) * len(candidate) / self.min_confidence + 1e-9))
+        if max_distance == 0:
+            return None
+        candidate_trigrams = trigrams(candidate)
+        minimum_shared = max(1, len(candidate_trigrams) - 3 * max_distance)
+        # A key sharing minimum_shared trigrams contains at least one of any len - minimum_shared + 1 of
+        # them: only the posting lists of the rarest ones are read
+        rarest = sorted(candidate_trigrams, key=lambda trigram: len(self.index.get(trigram, ())))
+        keys: Set[str] = set()
+        for trigram in rarest[:len(rarest) - minimum_shared + 1]:
+            keys.update(self.index.get(trigram, ()))
+        best: Optional[FuzzyMatch] = None
+        for key in sorted(keys):
+            if abs(len(key) - len(candidate)) > max_distance or \
+                    len(candidate_trigrams & self.trigrams[key]) < minimum_shared:
+                continue
+            distance = levenshtein(candidate, key, max_distance)
+            if distance > max_distance:
+                continue
+            confidence = 1 - distance / max(len(candidate), len(key))
+            if best is None or confidence > best.Confidence:
+                best = FuzzyMatch(self.keys[key], confidence, distance)
+        return best
+
+    def match(self, filename: str, extract_key: Callable[[str], str]) -> Optional[FuzzyMatch]:
+        best: Optional[FuzzyMatch] = None
+        for candidate in self.candidates(filename, extract_key):
+            result = self.lookup(candidate)
+            if result is not None and (best is None or result.Confidence > best.Confidence):
+                best = result
+        return best
@@ -0,0 +1,54 @@
+import json
+import os
+import threading
+from typing import Dict, List
+
+
+class LinkLedger:
+    """
+    Inbox files linked (instead of moved) into a series directory while their torrent keeps seeding.
+
+    Stored as JSON: inbox path -> {"destination", "method", "released"}. ManageQBittorent marks the
+    entries as released when it removes the torrent; MoveVideo then deletes the inbox copy.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries: Dict[str, dict] = dict()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def add(self, source: str, destination: str, method: str):
+        with self.lock:
+            self.entries[os.path.normpath(source)] = {"destination": destination, "method": method,
+                                                      "released": False}
+
+    def contains(self, source: str) -> bool:
+        return os.path.normpath(source) in self.entries
+
+    def release(self, directory: str) -> int:
+        # Marks the files under "directory" (a torrent content path in the inbox) as no longer seeding
+        directory = os.path.normpath(directory)
+        released = 0
+        with self.lock:
+            for source, entry in self.entries.items():
+                if source == directory or source.startswith(directory + os.sep):
+                    entry["released"] = True
+                    released += 1
+        return released
+
+    def released(self) -> List[str]:
+        return [source for source, entry in self.entries.items() if entry["released"]]
+
+    def remove(self, source: str):
+        with self.lock:
+            self.entries.pop(os.path.normpath(source), None)
+
+    def save(self):
+        with self.lock:
+            temp = self.path + ".tmp"
+            with open(temp, "w") as f:
+                json.dump(self.entries, f, indent=4)
+            os.replace(temp, self.path)
@@ -1,12 +1,26 @@
+import argparse
+import hashlib
 import json
 import os
+import posixpath
 import time
 
 import qbittorrentapi
+from requests.utils import cookiejar_from_dict, dict_from_cookiejar
 from qbittorrentapi import Client
 import configparser
 import logging
 
+from LinkLedger import LinkLedger
+from TorrentSnapshot import TorrentSnapshot
+
+DELETE_CHUNK = 100
+DELETE_RETRIES = 3
+SESSION = os.path.join('config', 'qbt_session.json')
+ROUTES = os.path.join('config', 'qbt_routes.json')
+WATCH_INTERVAL = 600
+SYNC_INTERVAL = 10
+
 logger = logging.getLogger("QBitTorrentClient")
 logger.setLevel(logging.DEBUG)
 ch = logging.StreamHandler()
@@ -36,57 +50,334 @@ def log_start(title):
 class QBitTorrentClient:
     conf: configparser.ConfigParser
     client: Client
+    snapshot: TorrentSnapshot
+    logged_in = False
+    session_saved = False
+    move_video = None
 
     def __init__(self):
         self.initialize()
 
+    def refresh_snapshot(self):
+        # One sync/maindata request per run, shared by the methods below
+        data = self.snapshot.refresh(self.client)
+        log(f"Torrents: {len(self.snapshot.torrents)} ({'full update' if data.get('full_update') else 'delta'}"
+            f", {len(data.get('torrents') or {})} changed, {len(data.get('torrents_removed') or [])} removed)")
+
     def get_active_torrents(self):
-        torrents = ()
-        if self.client.is_logged_in:
-            torrents = self.client.torrents_info()
-        active_torrents = [torrent for torrent in torrents if torrent['state'] == 'downloading']
-        return active_torrents
+        return self.snapshot.with_states(['downloading'])
 
     def log_torrents_report(self):
-        counters = {}
-        torrents = ()
-        if self.client.is_logged_in:
-            torrents = self.client.torrents_info()
-        for torrent in torrents:
-            parameter = torrent.state
-            if parameter in counters:
-                counters[parameter] += 1
-            else:
-                counters[parameter] = 1
-        log("counters for not valid duplicates: " + json.dumps(counters))
+        log("counters for not valid duplicates: " + json.dumps(self.snapshot.counters()))
 
     def get_completed_and_moved_torrents(self):
-        torrents = ()
-        if self.client.is_logged_in:
-            torrents = self.client.torrents_info()
-        completed_torrents = [torrent for torrent in torrents if (
-                (not torrent['content_path'].startswith(self.conf['Path']['Incomplete'])) and torrent[
-            'content_path'].startswith(self.conf['Path']['Downloads']) and torrent['state'] in ['pausedUP',
-                                                                                                'stalledUP',
-                                                                                                'queuedUP',
-                                                                                                'uploading',
-                                                                                                'stoppedUP',
-                                                                                                'missingFiles'])]
+        states = ['pausedUP', 'stalledUP', 'queuedUP', 'uploading', 'stoppedUP', 'missingFiles']
+        if self.is_link_mode():
+            # Files linked by MoveVideo: keep the torrents that are still seeding
+            states = ['pausedUP', 'stoppedUP', 'missingFiles']
+        completed_torrents = [torrent for torrent in self.snapshot.under(self.conf['Path']['Downloads']) if (
+                (not torrent['content_path'].startswith(self.conf['Path']['Incomplete'])) and
+                torrent['state'] in states)]
         return completed_torrents
 
+    def is_link_mode(self):
+        return self.conf.getboolean('MoveVideo', 'LinkMode', fallback=False)
+
+    def get_inbox_path(self, content_path):
+        # Content path seen by qBittorrent (under Path.Downloads) -> the same path in this container
+        relative_path = os.path.relpath(content_path, self.conf['Path']['Downloads'])
+        return os.path.normpath(os.path.join(self.conf.get('Path', 'Inbox', fallback='in'), relative_path))
+
+    def release_linked_sources(self, torrents):
+        # The inbox copies of the removed torrents can now be deleted by MoveVideo
+        ledger = LinkLedger(self.conf.get('MoveVideo', 'LinkLedger',
+                                          fallback=os.path.join('config', 'linked_sources.json')))
+        for torrent in torrents:
+            released = ledger.release(self.get_inbox_path(torrent['content_path']))
+            if released:
+                log(f"Released {released} linked files of {torrent['name']}")
+        ledger.save()
+
+    def is_set_location_mode(self):
+        # Linked files stay in the inbox: the torrents can not be relocated too
+        return self.conf.getboolean('QBittorent_Host', 'SetLocation', fallback=False) and not self.is_link_mode()
+
+    def get_move_video(self):
+        # MoveVideo checks its directories at import time: imported only when its routing is needed
+        if self.move_video is None:
+            from MoveVideo import MoveVideo
+            self.move_video = MoveVideo()
+        return self.move_video
+
+    def get_library_path(self, local_path):
+        # Directory under the out* roots in this container -> the same directory seen by qBittorrent (Path.Library)
+        library = self.conf.get('Path', 'Library', fallback='').rstrip('/')
+        root = os.path.abspath('.')
+        local_path = os.path.abspath(local_path)
+        if not library or not local_path.startswith(root + os.sep):
+            return None
+        return posixpath.join(library, *os.path.relpath(local_path, root).split(os.sep))
+
+    def load_routes(self):
+        path = self.conf.get('QBittorent_Host', 'Routes', fallback=ROUTES)
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                pass
+        return {}
+
+    def save_routes(self, routes):
+        path = self.conf.get('QBittorent_Host', 'Routes', fallback=ROUTES)
+        if not path:
+            return
+        # Only the torrents still known to qBittorrent
+        routes = {torrent_hash: route for torrent_hash, route in routes.items() if
+                  torrent_hash in self.snapshot.torrents}
+        temp = path + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(routes, f, indent=4)
+        os.replace(temp, path)
+
+    def route_torrents(self, torrents):
+        # Torrent hash -> series directory (as seen by qBittorrent), with the key rules of MoveVideo.
+        # The routes are cached per hash, so the destination index is read only for new torrents
+        routes = self.load_routes()
+        result = {}
+        index = None
+        for torrent in torrents:
+            route = routes.get(torrent['hash'])
+            if route is not None and route['name'] == torrent['name']:
+                result[torrent['hash']] = route['location']
+                continue
+            move_video = self.get_move_video()
+            if index is None:
+                output_dirs = move_video.get_output_dirs()
+                index = move_video.merge_destination_indexes(
+                    output_dirs, {output_dir: move_video.get_destination_index(output_dir) for output_dir in
+                                  output_dirs})
+            key = move_video.extract_key_from_filename(torrent['name']).lower()
+            if key not in index:
+                log(f"No destination for {torrent['name']} (key {key})")
+                continue
+            location = self.get_library_path(index[key][0])
+            if location is None:
+                log(f"No qBittorrent path for {index[key][0]} (set Path.Library)")
+                continue
+            routes[torrent['hash']] = {'name': torrent['name'], 'key': key, 'location': location}
+            result[torrent['hash']] = location
+        self.save_routes(routes)
+        return result
+
+    def relocate_torrents(self, torrents):
+        # qBittorrent moves the completed video files into their series directory and keeps seeding them.
+        # Torrents with a directory are left to MoveVideo, which moves their files one by one; torrents whose file
+        # is no longer in the inbox (already moved by MoveVideo) are not relocated.
+        # Returns the hashes of the relocated torrents
+        extensions = self.get_move_video().video_extensions
+        torrents = [torrent for torrent in torrents if
+                    torrent['state'] != 'missingFiles' and
+                    os.path.splitext(torrent['content_path'])[1].lower() in extensions and
+                    os.path.isfile(self.get_inbox_path(torrent['content_path']))]
+        torrents_by_hash = {torrent['hash']: torrent for torrent in torrents}
+        locations = {}
+        for torrent_hash, location in self.route_torrents(torrents).items():
+            locations.setdefault(location, []).append(torrent_hash)
+        relocated = set()
+        for location, torrent_hashes in locations.items():
+            try:
+                self.client.torrents_set_location(location=location, torrent_hashes=torrent_hashes)
+            except qbittorrentapi.APIError as e:
+                log(f"Error relocating {len(torrent_hashes)} torrents to {location}: {e}")
+                continue
+            relocated.update(torrent_hashes)
+            for torrent_hash in torrent_hashes:
+                log(f"Relocated {torrents_by_hash[torrent_hash]['name']} to {location}")
+        return relocated
+
+    def is_move_completed_mode(self):
+        return self.conf.getboolean('QBittorent_Host', 'MoveCompleted', fallback=False)
+
+    def get_completed_since_last_sync(self):
+        # Torrents completed since the previous sync/maindata, downloaded in Path.Downloads
+        torrents = [self.snapshot.torrents[torrent_hash] for torrent_hash in self.snapshot.completed]
+        return [torrent for torrent in torrents if
+                torrent['content_path'].startswith(self.conf['Path']['Downloads']) and
+                not torrent['content_path'].startswith(self.conf['Path']['Incomplete'])]
+
+    def move_completed_torrents(self, torrents):
+        # Only the files of the given torrents are routed by MoveVideo, without scanning the whole inbox.
+        # qBittorrent reports them as complete, so they are not left in place as recently modified
+        if not torrents:
+            return
+        move_video = self.get_move_video()
+        paths = []
+        for torrent in torrents:
+            inbox_path = self.get_inbox_path(torrent['content_path'])
+            if os.path.isdir(inbox_path):
+                paths.extend(entry.path for entry in
+                             move_video.scan_video_files(inbox_path, move_video.video_extensions))
+            else:
+                paths.append(inbox_path)
+            log(f"Completed {torrent['name']}")
+        output_dirs = move_video.get_output_dirs()
+        indexes = {output_dir: move_video.get_destination_index(output_dir) for output_dir in output_dirs}
+        deferred = move_video.move_paths(paths, output_dirs, indexes, stable_seconds=0)
+        if deferred:
+            log(f"{len(deferred)} files still open, left to the next MoveVideo run")
+
+    def sync(self):
+        # Watch mode, between two runs of main: only the torrents completed in the meantime are handled
+        self.snapshot.refresh(self.client)
+        torrents = self.get_completed_since_last_sync()
+        if torrents and self.is_set_location_mode():
+            relocated = self.relocate_torrents(torrents)
+            torrents = [torrent for torrent in torrents if torrent['hash'] not in relocated]
+        self.move_completed_torrents(torrents)
+        self.snapshot.save()
+
+    def delete_torrents(self, torrents):
+        # One torrents_delete request per chunk of hashes instead of one per torrent.
+        # A failed chunk is retried; returns the torrents actually removed
+        chunk_size = max(1, self.conf.getint('QBittorent_Host', 'DeleteChunk', fallback=DELETE_CHUNK))
+        retries = max(1, self.conf.getint('QBittorent_Host', 'DeleteRetries', fallback=DELETE_RETRIES))
+        deleted = []
+        failed = []
+        requests = 0
+        for start in range(0, len(torrents), chunk_size):
+            chunk = torrents[start:start + chunk_size]
+            for attempt in range(1, retries + 1):
+                requests += 1
+                try:
+                    self.client.torrents_delete(delete_files=False,
+                                                torrent_hashes=[torrent['hash'] for torrent in chunk])
+                    deleted.extend(chunk)
+                    break
+                except qbittorrentapi.APIError as e:
+                    log(f"Error deleting {len(chunk)} torrents (attempt {attempt}/{retries}): {e}")
+                    if attempt == retries:
+                        failed.extend(chunk)
+                    else:
+                        time.sleep(attempt)
+        for torrent in deleted:
+            log("Deleted torrent with name " + torrent['name'])
+        if torrents:
+            log(f"Deleted {len(deleted)}/{len(torrents)} torrents with {requests} requests")
+        if failed:
+            log("Torrents not deleted: " + json.dumps([torrent['name'] for torrent in failed]))
+        return deleted
+
+    def load_session(self):
+        if self.session_path and os.path.exists(self.session_path):
+            try:
+                with open(self.session_path) as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                pass
+        return {}
+
+    def save_session(self, session):
+        if not self.session_path:
+            return
+        temp = self.session_path + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(session, f)
+        os.replace(temp, self.session_path)
+
+    def log_in(self):
+        # Reuses the session cookies saved by the previous run and logs in only when they are missing or expired.
+        # The whole cookie jar is saved: the name of the session cookie depends on the qBittorrent version
+        # ("SID", "QBT_SID_<port>" since 5.2).
+        # The build info is logged only when the connection settings or the qBittorrent version changed
+        session = self.load_session()
+        version = None
+        if session.get('cookies'):
+            self.client._session.cookies.update(cookiejar_from_dict(session['cookies']))
+            try:
+                version = self.client.app_version()
+            except qbittorrentapi.Forbidden403Error:
+                log("Saved qBittorrent session expired")
+        if version is None:
+            self.client.auth_log_in()
+            version = self.client.app_version()
+        self.logged_in = True
+        config_hash = hashlib.sha256(json.dumps([dict(self.conf['QBittorent_Host']), version],
+                                                sort_keys=True).encode()).hexdigest()
+        if config_hash != session.get('config_hash'):
+            self.log_build_info()
+        cookies = dict_from_cookiejar(self.client._session.cookies)
+        self.session_saved = bool(self.session_path and cookies)
+        self.save_session({'cookies': cookies, 'config_hash': config_hash})
+
+    def log_build_info(self):
+        log_start("Config")
+        log(f"qBittorrent: {self.client.app.version}")
+        log(f"qBittorrent Web API: {self.client.app.web_api_version}")
+        for k, v in self.client.app.build_info.items():
+            log(f"{k}: {v}")
+        log_end("Config")
+
+    def log_out(self):
+        # With a saved session the cookies must stay valid for the next run
+        if self.logged_in and not self.session_saved:
+            self.client.auth_log_out()
+            self.logged_in = False
+
+    def watch(self, interval):
+        # Long running mode: one session and one HTTP connection pool for all the runs.
+        # With MoveCompleted the torrents are synchronized every SyncInterval seconds, so that a completed
+        # download is moved within seconds
+        log_start("Watch")
+        sync_interval = self.conf.getfloat('QBittorent_Host', 'SyncInterval', fallback=SYNC_INTERVAL)
+        last_main = None
+        try:
+            while True:
+                try:
+                    if not self.logged_in:
+                        self.log_in()
+                    if last_main is None or time.monotonic() - last_main >= interval:
+                        last_main = time.monotonic()
+                        self.main()
+                    elif self.is_move_completed_mode():
+                        self.sync()
+                except qbittorrentapi.Forbidden403Error:
+                    log("qBittorrent session expired")
+                    self.logged_in = False
+                except qbittorrentapi.APIError as e:
+                    log(e)
+                time.sleep(min(interval, sync_interval) if self.is_move_completed_mode() else interval)
+        except KeyboardInterrupt:
+            pass
+        self.log_out()
+        log_end("Watch")
+
     def main(self):
         log_start("Main")
-        self.client.auth_log_in()
+        if not self.logged_in:
+            # The saved snapshot alone could be stale: nothing is removed without a fresh one
+            log("Not logged in to qBittorrent")
+            log_end("Main")
+            return
+        self.refresh_snapshot()
         self.log_torrents_report()
         for torrent in self.get_active_torrents():
-            log(f"{torrent.hash}: {torrent.name} ({torrent.state})")
+            log(f"{torrent['hash']}: {torrent['name']} ({torrent['state']})")
         torrents = self.get_completed_and_moved_torrents()
         for torrent in torrents:
-            log(f"{torrent.hash}: {torrent.name} ({torrent.state})")
-        for torrent in torrents:
-            self.client.torrents_delete(delete_files=False, torrent_hashes=[torrent.hash])
-            log("Deleted torrent with name " + torrent.name)
-        self.client.auth_log_out()
+            log(f"{torrent['hash']}: {torrent['name']} ({torrent['state']})")
+        relocated = set()
+        if self.is_set_location_mode():
+            relocated = self.relocate_torrents(torrents)
+            torrents = [torrent for torrent in torrents if torrent['hash'] not in relocated]
+        if self.is_move_completed_mode():
+            self.move_completed_torrents([torrent for torrent in self.get_completed_since_last_sync() if
+                                          torrent['hash'] not in relocated])
+        deleted = self.delete_torrents(torrents)
+        self.snapshot.remove(torrent['hash'] for torrent in deleted)
+        if self.is_link_mode():
+            self.release_linked_sources(deleted)
+        self.snapshot.save()
 
         log_end("Main")
 
@@ -105,15 +396,11 @@ class QBitTorrentClient:
             "password": self.conf["QBittorent_Host"]["password"]
         }
         self.client = qbittorrentapi.Client(**args)
+        self.snapshot = TorrentSnapshot(self.conf.get("QBittorent_Host", "Snapshot",
+                                                      fallback=os.path.join('config', 'qbt_snapshot.json')))
+        self.session_path = self.conf.get("QBittorent_Host", "Session", fallback=SESSION)
         try:
-            self.client.auth_log_in()
-            log_start("Config")
-            log(f"qBittorrent: {self.client.app.version}")
-            log(f"qBittorrent Web API: {self.client.app.web_api_version}")
-            for k, v in self.client.app.build_info.items():
-                log(f"{k}: {v}")
-            log_end("Config")
-            self.client.auth_log_out()
+            self.log_in()
         except qbittorrentapi.LoginFailed as e:
             log(e)
         except Exception as e:
@@ -121,5 +408,13 @@ class QBitTorrentClient:
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Remove the completed torrents from qBittorrent')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running with one session, repeating every WatchInterval seconds')
+    args = parser.parse_args()
     qb_api = QBitTorrentClient()
-    qb_api.main()
+    if args.watch:
+        qb_api.watch(qb_api.conf.getfloat('QBittorent_Host', 'WatchInterval', fallback=WATCH_INTERVAL))
+    else:
+        qb_api.main()
+        qb_api.log_out()
@@ -0,0 +1,70 @@
+import json
+import os
+import threading
+from typing import Dict, Tuple
+
+
+class MoveJournal:
+    """
+    Write-ahead journal of the cross-device moves in progress, one JSON object per line.
+
+    A move is recorded ("begin") before the first byte is copied, the copied offset is recorded
+    ("checkpoint") after every fsync of the temporary file and the move is closed ("done") once
+    the source has been removed. After a crash, the moves without "done" are the pending ones.
+    Moves are identified by source and temporary file, which is unique to every copy: two moves
+    towards the same destination never share an entry.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def record(self, entry: dict):
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def begin(self, source: str, destination: str, temp: str, size: int):
+        self.record({"op": "begin", "source": source, "destination": destination, "temp": temp, "size": size,
+                     "offset": 0})
+
+    def checkpoint(self, source: str, temp: str, offset: int):
+        self.record({"op": "checkpoint", "source": source, "temp": temp, "offset": offset})
+
+    def done(self, source: str, temp: str):
+        self.record({"op": "done", "source": source, "temp": temp})
+
+    def pending(self) -> Dict[Tuple[str, str], dict]:
+        # (source, temp) -> last state of every move not closed with "done"
+        moves: Dict[Tuple[str, str], dict] = dict()
+        if not os.path.exists(self.path):
+            return moves
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Last line truncated by the crash
+                    continue
+                key = (entry.get("source"), entry.get("temp"))
+                if entry["op"] == "begin":
+                    moves[key] = entry
+                elif entry["op"] == "checkpoint" and key in moves:
+                    moves[key]["offset"] = entry["offset"]
+                elif entry["op"] == "done":
+                    moves.pop(key, None)
+        return moves
+
+    def compact(self):
+        # Rewrites the journal keeping only the pending moves
+        with self.lock:
+            moves = self.pending()
+            temp = self.path + ".tmp"
+            with open(temp, "w") as f:
+                for entry in moves.values():
+                    f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp, self.path)
@@ -1,11 +1,24 @@
+import argparse
+import configparser
+import json
 import os
 import shutil
 import sys
+import time
 from collections import namedtuple
 from pathlib import Path
-from typing import List
+from typing import Dict, Iterator, List, Optional, Set, Tuple
 
+from DestinationCache import DestinationIndexCache
+from FileStability import files_open_for_writing
+from FuzzyMatcher import FuzzyMatcher
+from LinkLedger import LinkLedger
 from Log import Logger
+from MoveJournal import MoveJournal
+from Mover import MoveExecutor, MoveJob
+from OsHash import OsHashIndex, oshash
+from TorrentSnapshot import TorrentSnapshot
+from Watcher import WatchEvent, create_watcher
 
 VERSION = "0.1"
 
@@ -14,6 +27,20 @@ DIR_OUT = "out"
 DIR_OUT_ROOT = "."
 DIR_OUT_LABEL = "out"
 MIN_DIR_SIZE = 1000
+VIDEO_EXTENSIONS = ".mkv,.avi,.mp4,.m4v,.ts"
+INDEX_CACHE = os.path.join('config', 'destination_index.sqlite')
+MOVE_JOURNAL = os.path.join('config', 'move_journal.jsonl')
+LINK_LEDGER = os.path.join('config', 'linked_sources.json')
+HASH_INDEX = os.path.join('config', 'oshash_index.sqlite')
+DIR_DUPLICATES = os.path.join(DIR_IN, '_duplicates')
+TORRENT_SNAPSHOT = os.path.join('config', 'qbt_snapshot.json')
+WATCH_DEBOUNCE = 10
+MOVE_CONCURRENCY = 2
+STABLE_SECONDS = 60
+FUZZY_THRESHOLD = 0.85
+FUZZY_MAX_DISTANCE = 2
+WATCH_POLL_INTERVAL = 60
+WATCH_CLEANUP_INTERVAL = 600
 
 if not os.path.isdir(DIR_IN):
     raise Exception(f"Directory {DIR_IN} does not exist")
@@ -21,75 +48,242 @@ if not os.path.isdir(DIR_IN):
 if not os.path.isdir(DIR_OUT):
     raise Exception(f"Directory {DIR_OUT} does not exist")
 
+SourceItem = namedtuple("SourceItem", ["File", "Path", "Key", "Size", "Mtime"])
+
 
 class MoveVideo:
     def __init__(self):
         self.logger = Logger("MoveVideo")
+        self.conf = self.parse_config()
+        self.video_extensions = self.parse_extensions(
+            self.conf.get("MoveVideo", "Extensions", fallback=VIDEO_EXTENSIONS))
+        self.index_cache_path = self.conf.get("MoveVideo", "IndexCache", fallback=INDEX_CACHE)
+        self.index_cache = None
+        self.move_concurrency = self.conf.getint("MoveVideo", "MoveConcurrency", fallback=MOVE_CONCURRENCY)
+        self.move_journal_path = self.conf.get("MoveVideo", "Journal", fallback=MOVE_JOURNAL)
+        self.link_mode = self.conf.getboolean("MoveVideo", "LinkMode", fallback=False)
+        self.link_ledger_path = self.conf.get("MoveVideo", "LinkLedger", fallback=LINK_LEDGER)
+        self.watch_debounce = self.conf.getfloat("MoveVideo", "WatchDebounce", fallback=WATCH_DEBOUNCE)
+        self.watch_poll_interval = self.conf.getfloat("MoveVideo", "WatchPollInterval", fallback=WATCH_POLL_INTERVAL)
+        self.watch_cleanup_interval = self.conf.getfloat("MoveVideo", "WatchCleanupInterval",
+                                                         fallback=WATCH_CLEANUP_INTERVAL)
+        self.stable_seconds = self.conf.getfloat("MoveVideo", "StableSeconds", fallback=STABLE_SECONDS)
+        self.check_open_files = self.conf.getboolean("MoveVideo", "CheckOpenFiles", fallback=True)
+        self.duplicate_check = self.conf.getboolean("MoveVideo", "DuplicateCheck", fallback=False)
+        self.hash_index_path = self.conf.get("MoveVideo", "HashIndex", fallback=HASH_INDEX)
+        self.duplicates_dir = self.conf.get("MoveVideo", "Duplicates", fallback=DIR_DUPLICATES)
+        self.set_location = self.conf.getboolean("QBittorent_Host", "SetLocation", fallback=False)
+        self.torrent_snapshot_path = self.conf.get("QBittorent_Host", "Snapshot", fallback=TORRENT_SNAPSHOT)
+        self.excluded_dirs = self.get_excluded_dirs()
+        self.fuzzy_match = self.conf.getboolean("MoveVideo", "FuzzyMatch", fallback=False)
+        self.fuzzy_threshold = self.conf.getfloat("MoveVideo", "FuzzyThreshold", fallback=FUZZY_THRESHOLD)
+        self.fuzzy_max_distance = self.conf.getint("MoveVideo", "FuzzyMaxDistance", fallback=FUZZY_MAX_DISTANCE)
+        self.fuzzy_matcher: Optional[FuzzyMatcher] = None
+        self.fuzzy_keys: Set[str] = set()
+
+    def parse_config(self):
+        conf = configparser.ConfigParser()
+        defaults_path = os.path.join('config', 'config.toml')
+        conf.read(defaults_path)
+        return conf
+
+    def parse_extensions(self, extensions: str) -> Set[str]:
+        # Le estensioni sono confrontate in minuscolo, quindi ".MKV" e ".mkv" sono equivalenti
+        result = set()
+        for ext in extensions.split(','):
+            ext = ext.strip().lower()
+            if ext:
+                result.add(ext if ext.startswith('.') else '.' + ext)
+        return result
 
-    def get_directory_size(self, directory_path):
+    def get_excluded_dirs(self) -> Set[str]:
+        # Directory dei download incompleti (Path.Incomplete): il percorso è quello visto da qBittorrent,
+        # quindi viene escluso sia così com'è sia riportato sotto DIR_IN rispetto a Path.Downloads
+        result = set()
+        incomplete = self.conf.get("Path", "Incomplete", fallback="").rstrip("/")
+        if incomplete:
+            result.add(os.path.abspath(incomplete))
+            downloads = self.conf.get("Path", "Downloads", fallback="").rstrip("/")
+            if downloads and incomplete.startswith(downloads + "/"):
+                result.add(os.path.abspath(os.path.join(DIR_IN, os.path.relpath(incomplete, downloads))))
+        if self.duplicate_check:
+            # I doppioni messi da parte non vengono più considerati file da spostare
+            result.add(os.path.abspath(self.duplicates_dir))
+        return result
+
+    def is_excluded(self, path) -> bool:
+        absolute_path = os.path.abspath(path)
+        return any(absolute_path == x or absolute_path.startswith(x + os.sep) for x in self.excluded_dirs)
+
+    def prune_small_directories(self, directory_path, deleted: List[str],
+                                dry_run=False) -> Tuple[int, List[str], bool]:
+        # Visita in post-ordine: ogni elemento viene letto una sola volta e le sottodirectory piccole
+        # vengono rimosse prima della directory che le contiene.
+        # Restituisce la dimensione della directory (escluse le directory in excluded_dirs), l'elenco dei suoi
+        # file e se deve essere mantenuta comunque perché contiene una directory esclusa
         total_size = 0
+        files: List[str] = list()
+        keep = False
         with os.scandir(directory_path) as it:
-            for entry in it:
-                if entry.is_file():
+            entries = list(it)
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False) and os.path.abspath(entry.path) in self.excluded_dirs:
+                # Download incompleti: mai cancellati, insieme alle directory che li contengono
+                keep = True
+            elif entry.is_dir(follow_symlinks=False):
+                size, sub_files, sub_keep = self.prune_small_directories(entry.path, deleted, dry_run)
+                self.logger.log(f"Size {entry.path} is {size} bytes")
+                if sub_keep:
+                    keep = True
+                elif size < MIN_DIR_SIZE:
+                    self.delete_directory(entry.path, sub_files, size, dry_run)
+                    deleted.append(entry.path)
+                total_size += size
+            else:
+                files.append(entry.path)
+                try:
                     total_size += entry.stat().st_size
-                elif entry.is_dir():
-                    total_size += self.get_directory_size(entry.path)
-        return total_size
+                except OSError:
+                    # Symlink non valido
+                    pass
+        return total_size, files, keep
+
+    def delete_directory(self, dir_path, files: List[str], size, dry_run=False):
+        if dry_run:
+            self.logger.log(f"Would delete {dir_path} with size {size} bytes")
+            return
+        for file_path in files:
+            os.remove(file_path)
+            self.logger.log(f"Deleting {file_path}")
+        self.logger.log(f"Deleting {dir_path} with size {size} bytes")
+        os.rmdir(dir_path)
 
-    def delete_small_directories(self, directory_path):
+    def delete_small_directories(self, directory_path, dry_run=False) -> List[str]:
         self.logger.log_start(f"Deleting small directories in {directory_path}")
-        for root, dirs, files in os.walk(directory_path):
-            for dir in dirs:
-                dir_path = os.path.join(root, dir)
-                size = self.get_directory_size(dir_path)
-                self.logger.log(f"Size {dir_path} is {size} bytes")
-                if size < MIN_DIR_SIZE:
-                    for file_name in os.listdir(dir_path):
-                        file_path = os.path.join(dir_path, file_name)
-                        if os.path.isfile(file_path):
-                            os.remove(file_path)
-                            self.logger.log(f"Deleting {file_path}")
-                    self.logger.log(f"Deleting {dir_path} with size {size} bytes")
-                    os.rmdir(dir_path)
+        deleted: List[str] = list()
+        self.prune_small_directories(directory_path, deleted, dry_run)
         self.logger.log_end(f"Deleting small directories in {directory_path}")
+        return deleted
 
-    def generate_source_list(self):
-        Item = namedtuple("Item", ["File", "Path", "Key"])
-        item_list: List[Item] = list()
-
-        # Cerca tutti i file .mkv, .avi e .mp4 in modo ricorsivo all'interno della directory DIR_IN
-        # e salva il nome del file, il percorso completo e la chiave del file nella lista degli oggetti "Item"
-        for txt_file in Path(DIR_IN).rglob('*.mkv'):
-            key: str = self.extract_key_from_filename(txt_file.name)
-            item_list.append(Item(txt_file.name, txt_file, key.lower()))
-        for txt_file in Path(DIR_IN).rglob('*.avi'):
-            key: str = self.extract_key_from_filename(txt_file.name)
-            item_list.append(Item(txt_file.name, txt_file, key.lower()))
-        for txt_file in Path(DIR_IN).rglob('*.mp4'):
-            key: str = self.extract_key_from_filename(txt_file.name)
-            item_list.append(Item(txt_file.name, txt_file, key.lower()))
+    def scan_video_files(self, directory_path, extensions: Set[str]) -> Iterator[os.DirEntry]:
+        # Visita l'albero una sola volta con os.scandir (stack esplicito, niente ricorsione)
+        # e restituisce i file video man mano che vengono trovati
+        pending = [directory_path]
+        while pending:
+            current = pending.pop()
+            try:
+                with os.scandir(current) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            if os.path.abspath(entry.path) not in self.excluded_dirs:
+                                pending.append(entry.path)
+                        elif os.path.splitext(entry.name)[1].lower() in extensions and entry.is_file():
+                            yield entry
+            except OSError as e:
+                self.logger.log(f"Unable to scan {current}: {e}")
+
+    def generate_source_list(self, directory_path=DIR_IN):
+        item_list: List[SourceItem] = list()
+
+        # Cerca tutti i file video in modo ricorsivo all'interno della directory DIR_IN con un'unica visita
+        # e salva il nome del file, il percorso completo e la chiave del file nella lista degli oggetti "SourceItem"
+        for entry in self.scan_video_files(directory_path, self.video_extensions):
+            key: str = self.extract_key_from_filename(entry.name)
+            stat = entry.stat()
+            item_list.append(SourceItem(entry.name, Path(entry.path), key.lower(), stat.st_size, stat.st_mtime))
         return item_list
 
-    def generate_destination_list(self, dir_out=DIR_OUT):
-        Item = namedtuple("Item", ["Dir", "Path", "Key"])
-        item_list: List[Item] = list()
+    def make_source_item(self, file_path: str):
+        # Restituisce None se il file non esiste più o non è un file video
+        name = os.path.basename(file_path)
+        if os.path.splitext(name)[1].lower() not in self.video_extensions or self.is_excluded(file_path):
+            return None
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        if not os.path.isfile(file_path):
+            return None
+        return SourceItem(name, Path(file_path), self.extract_key_from_filename(name).lower(), stat.st_size,
+                          stat.st_mtime)
+
+    def split_stable_sources(self, source_list: List[SourceItem],
+                             stable_seconds: float = None) -> Tuple[List[SourceItem], List[SourceItem]]:
+        # Separa i file ancora in scrittura (modificati di recente o aperti in scrittura da un processo),
+        # che vengono rimandati all'esecuzione successiva invece di essere copiati
+        stable_seconds = self.stable_seconds if stable_seconds is None else stable_seconds
+        now = time.time()
+        open_files = files_open_for_writing(DIR_IN) if self.check_open_files else set()
+        stable: List[SourceItem] = list()
+        deferred: List[SourceItem] = list()
+        for source in source_list:
+            if now - source.Mtime < stable_seconds:
+                deferred.append(source)
+            elif open_files and os.path.realpath(source.Path) in open_files:
+                deferred.append(source)
+            else:
+                stable.append(source)
+        if deferred:
+            self.logger.log("Deferred files (still being written):")
+            self.logger.log([x.File for x in deferred])
+        return stable, deferred
+
+    def generate_destination_list(self, dir_out=DIR_OUT) -> Dict[str, List[Path]]:
+        index: Dict[str, List[Path]] = dict()
         p = Path(dir_out)
 
         # Cerca tutte le directory o i symlink presenti nella directory DIR_OUT.
         # Per ogni nome di directory trovato, estrae le chiavi dal nome della directory
-        # e le salva nella lista degli oggetti "Item"
+        # e costruisce l'indice chiave -> directory (la prima directory trovata ha la precedenza)
         for txt_file in [f for f in p.iterdir() if (f.is_dir() or f.is_symlink())]:
-            keys = self.extract_keys_from_directory_name(txt_file.name)
-            for key in keys:
-                if key.startswith("_"):
-                    # Remove underscore for directories with multi group (starting with underscore)
-                    item_list.append(Item(txt_file.name, txt_file, key[1:]))
-                else:
-                    item_list.append(Item(txt_file.name, txt_file.resolve(), key))
-                    if key.endswith("N"):
-                        # Calculate also key for collection based on N (ending with N)
-                        item_list.append(Item(txt_file.name, txt_file.resolve(), key[:-1]))
-        return item_list
+            self.add_destination_keys(index, txt_file)
+        return index
+
+    def add_destination_keys(self, index: Dict[str, List[Path]], directory: Path):
+        for key, path in self.extract_destination_keys(directory):
+            paths = index.setdefault(key, [])
+            if path not in paths:
+                paths.append(path)
+
+    def remove_destination_keys(self, index: Dict[str, List[Path]], directory: Path):
+        # La directory non esiste più, quindi non è possibile risolverne il percorso:
+        # vengono rimossi i percorsi con lo stesso nome o che non esistono più
+        for key in self.extract_keys_from_directory_name(directory.name):
+            key = key[1:] if key.startswith("_") else key
+            paths = [x for x in index.get(key, []) if x.name != directory.name and x.exists()]
+            if paths:
+                index[key] = paths
+            else:
+                index.pop(key, None)
+
+    def get_destination_index(self, dir_out=DIR_OUT) -> Dict[str, List[Path]]:
+        # Usa l'indice salvato su disco quando la directory non è cambiata dall'ultima esecuzione
+        if not self.index_cache_path:
+            return self.generate_destination_list(dir_out)
+        if self.index_cache is None:
+            self.index_cache = DestinationIndexCache(self.index_cache_path)
+        index, cached = self.index_cache.load(dir_out, self.generate_destination_list)
+        self.logger.log(f"Destination index for {dir_out} {'loaded from cache' if cached else 'rebuilt'}")
+        return index
+
+    def extract_destination_keys(self, directory: Path) -> List[Tuple[str, Path]]:
+        result = list()
+        resolved = None
+        for key in self.extract_keys_from_directory_name(directory.name):
+            if key.startswith("_"):
+                # Remove underscore for directories with multi group (starting with underscore)
+                result.append((key[1:], directory))
+            else:
+                if resolved is None:
+                    resolved = directory.resolve()
+                result.append((key, resolved))
+        return result
+
+    def group_sources_by_key(self, source_list) -> Dict[str, list]:
+        sources_by_key: Dict[str, list] = dict()
+        for item in source_list:
+            sources_by_key.setdefault(item.Key, []).append(item)
+        return sources_by_key
 
     def extract_key_from_filename(self, file_in):
         if file_in.find('[') == 0:
@@ -116,45 +310,337 @@ class MoveVideo:
                 result.append(key[:-1])
         return result
 
-    def move_files(self, dir_out=DIR_OUT):
-        self.logger.log_start(f"Moving files from {DIR_IN} to {dir_out}")
-        source_list = self.generate_source_list()
-        destination_list = self.generate_destination_list(dir_out)
+    def route_sources(self, source_list: List[SourceItem], destination_index: Dict[str, List[Path]]) -> List[MoveJob]:
+        sources_by_key = self.group_sources_by_key(source_list)
+
+        found_key_list = [key for key in sources_by_key if key in destination_index]
+        missing_key_list = [key for key in sources_by_key if key not in destination_index]
+        ambiguous_key_list = {key: [str(x) for x in destination_index[key]] for key in found_key_list if
+                              len(destination_index[key]) > 1}
+
+        self.logger.log("Found keys:")
+        self.logger.log(found_key_list)
+        self.logger.log("Missing keys:")
+        self.logger.log(missing_key_list)
+        if ambiguous_key_list:
+            # Chiavi associate a più directory: viene usata la prima trovata
+            self.logger.log("Ambiguous keys:")
+            self.logger.log(ambiguous_key_list)
+
+        jobs: List[MoveJob] = list()
+        for key_name in found_key_list:
+            destination_dir = destination_index[key_name][0]
+
+            for source in sources_by_key[key_name]:
+                jobs.append(self.make_move_job(source, destination_dir))
+
+        if self.fuzzy_match and missing_key_list:
+            jobs.extend(self.route_fuzzy_sources([x for key in missing_key_list for x in sources_by_key[key]],
+                                                 destination_index))
+        return jobs
+
+    def route_fuzzy_sources(self, source_list: List[SourceItem],
+                            destination_index: Dict[str, List[Path]]) -> List[MoveJob]:
+        # Cerca una chiave simile per i file senza corrispondenza esatta: il file viene spostato
+        # solo se la confidenza è almeno pari a fuzzy_threshold
+        matcher = self.get_fuzzy_matcher(destination_index)
+        jobs: List[MoveJob] = list()
+        for source in source_list:
+            match = matcher.match(source.File, self.extract_key_from_filename)
+            if match is None:
+                continue
+            destination_dir = destination_index[match.Key][0]
+            if match.Confidence < self.fuzzy_threshold:
+                self.logger.log(f"Fuzzy match {source.File} -> {destination_dir} "
+                                f"(confidence {match.Confidence:.2f}) below threshold")
+                continue
+            self.logger.log(f"Fuzzy match {source.File} -> {destination_dir} (confidence {match.Confidence:.2f})")
+            jobs.append(self.make_move_job(source, destination_dir))
+        return jobs
+
+    def get_fuzzy_matcher(self, destination_index: Dict[str, List[Path]]) -> FuzzyMatcher:
+        # L'indice trigram viene ricostruito solo quando cambiano le chiavi di destinazione
+        if self.fuzzy_matcher is None or self.fuzzy_keys != destination_index.keys():
+            self.fuzzy_matcher = FuzzyMatcher(destination_index.keys(), self.fuzzy_max_distance, self.fuzzy_threshold)
+            self.fuzzy_keys = set(destination_index.keys())
+        return self.fuzzy_matcher
+
+    def create_executor(self) -> MoveExecutor:
+        journal = MoveJournal(self.move_journal_path) if self.move_journal_path else None
+        link_ledger = LinkLedger(self.link_ledger_path) if self.link_mode else None
+        return MoveExecutor(self.logger, self.move_concurrency, journal, link_ledger)
+
+    def skip_linked_sources(self, source_list: List[SourceItem]) -> List[SourceItem]:
+        # In modalità link i file già collegati restano in DIR_IN finché il torrent è attivo
+        if not self.link_mode:
+            return source_list
+        link_ledger = LinkLedger(self.link_ledger_path)
+        return [x for x in source_list if not link_ledger.contains(str(x.Path))]
+
+    def skip_relocated_sources(self, source_list: List[SourceItem]) -> List[SourceItem]:
+        # Con QBittorent_Host.SetLocation i torrent con un solo file video vengono spostati da qBittorrent
+        # (ManageQBittorent): i loro file restano in DIR_IN finché il torrent esiste, in base all'ultimo
+        # elenco dei torrent salvato da ManageQBittorent
+        if not self.set_location or self.link_mode or not self.torrent_snapshot_path:
+            return source_list
+        downloads = self.conf.get("Path", "Downloads", fallback="").rstrip("/")
+        if not downloads:
+            return source_list
+        relocated = set()
+        for torrent in TorrentSnapshot(self.torrent_snapshot_path).torrents.values():
+            content_path = torrent.get("content_path", "")
+            if torrent.get("state") != "missingFiles" and content_path.startswith(downloads + "/") and \
+                    os.path.splitext(content_path)[1].lower() in self.video_extensions:
+                relocated.add(os.path.abspath(os.path.join(DIR_IN, os.path.relpath(content_path, downloads))))
+        skipped = [x for x in source_list if os.path.abspath(x.Path) in relocated]
+        if skipped:
+            self.logger.log("Files left to qBittorrent (SetLocation):")
+            self.logger.log([x.File for x in skipped])
+        return [x for x in source_list if os.path.abspath(x.Path) not in relocated]
+
+    def cleanup_linked_sources(self):
+        # Rimuove da DIR_IN i file collegati il cui torrent è stato rimosso da ManageQBittorent,
+        # solo se il collegamento nella directory di destinazione esiste ancora
+        link_ledger = LinkLedger(self.link_ledger_path)
+        released = link_ledger.released()
+        if not released:
+            return
+        self.logger.log_start("Cleaning up linked sources")
+        for source in released:
+            destination = link_ledger.entries[source]["destination"]
+            try:
+                if not os.path.exists(source):
+                    link_ledger.remove(source)
+                elif os.path.exists(destination) and os.path.getsize(destination) == os.path.getsize(source):
+                    os.remove(source)
+                    link_ledger.remove(source)
+                    self.logger.log(f"Deleted {source}, linked as {destination}")
+                else:
+                    self.logger.log(f"Keeping {source}: link {destination} not found")
+            except OSError as e:
+                self.logger.log(f"Error deleting {source}: {e}")
+        link_ledger.save()
+        self.logger.log_end("Cleaning up linked sources")
+
+    def find_duplicates(self, jobs: List[MoveJob]) -> Tuple[List[MoveJob], List[Tuple[str, str]]]:
+        # Confronta l'oshash di ogni file con quello dei file già presenti nella directory di destinazione
+        # (e dei file diretti nella stessa directory): i doppioni esatti non vengono copiati.
+        # Restituisce gli spostamenti da eseguire e le coppie (file, file già presente)
+        if not self.duplicate_check or not jobs:
+            return jobs, []
+        hash_index = OsHashIndex(self.hash_index_path)
+        unique: List[MoveJob] = list()
+        duplicates: List[Tuple[str, str]] = list()
+        try:
+            for job in jobs:
+                destination_dir = os.path.dirname(job.destination)
+                try:
+                    value = oshash(job.source)
+                    hashes = hash_index.directory_hashes(destination_dir, self.video_extensions)
+                except OSError as e:
+                    self.logger.log(f"Unable to compute the oshash of {job.source}: {e}")
+                    unique.append(job)
+                    continue
+                if value is not None and value in hashes:
+                    duplicates.append((job.source, hashes[value]))
+                    continue
+                if value is not None:
+                    hash_index.add(destination_dir, value, job.destination)
+                unique.append(job)
+        finally:
+            hash_index.close()
+        if duplicates:
+            self.logger.log("Duplicate files:")
+            self.logger.log({source: original for source, original in duplicates})
+        return unique, duplicates
+
+    def quarantine_duplicates(self, duplicates: List[Tuple[str, str]]):
+        # I doppioni vengono spostati in duplicates_dir per un controllo manuale, mai cancellati.
+        # In modalità link restano dove sono, perché il torrent li sta ancora condividendo
+        for source, original in duplicates:
+            if self.link_mode:
+                self.logger.log(f"Skipping {source}: duplicate of {original}")
+                continue
+            target = os.path.join(self.duplicates_dir, os.path.basename(source))
+            if os.path.exists(target):
+                name, extension = os.path.splitext(os.path.basename(source))
+                target = os.path.join(self.duplicates_dir, f"{name}.{time.strftime('%Y%m%d%H%M%S')}{extension}")
+            try:
+                os.makedirs(self.duplicates_dir, exist_ok=True)
+                shutil.move(source, target)
+                self.logger.log(f"Quarantined {source} to {target}: duplicate of {original}")
+            except OSError as e:
+                self.logger.log(f"Error quarantining {source}: {e}")
+
+    def make_move_job(self, source: SourceItem, destination_dir: Path) -> MoveJob:
+        destination_file = os.path.join(str(Path(destination_dir)), source.File)
+        return MoveJob(source=str(source.Path), destination=destination_file, size=source.Size, key=source.Key)
+
+    def merge_destination_indexes(self, output_dirs: List[str],
+                                  indexes: Dict[str, Dict[str, List[Path]]]) -> Dict[str, List[Path]]:
+        # Unisce gli indici delle directory di output: a parità di chiave vince la directory
+        # che compare prima in output_dirs, le altre restano come alternative (chiavi ambigue)
+        merged: Dict[str, List[Path]] = dict()
+        for output_dir in output_dirs:
+            for key, paths in indexes[output_dir].items():
+                merged_paths = merged.setdefault(key, [])
+                merged_paths.extend(x for x in paths if x not in merged_paths)
+        return merged
+
+    def plan_moves(self, output_dirs: List[str]) -> List[MoveJob]:
+        source_list, _ = self.split_stable_sources(
+            self.skip_relocated_sources(self.skip_linked_sources(self.generate_source_list())))
+        indexes = {output_dir: self.get_destination_index(output_dir) for output_dir in output_dirs}
+        destination_index = self.merge_destination_indexes(output_dirs, indexes)
 
         source_key_list = [sub.Key for sub in source_list]
         source_filename_list = [sub.File for sub in source_list]
-        destination_dir_list = [sub.Dir for sub in destination_list]
-        destination_key_list = [sub.Key for sub in destination_list]
 
         self.logger.log("Source filenames:")
         self.logger.log(source_filename_list)
         self.logger.log("Source keys:")
         self.logger.log(source_key_list)
-        #    log("Destination directories:")
-        #    log(destination_dir_list)
-        # log("Destination keys:")
-        # log(destination_key_list)
 
-        found_key_list = list(set(source_key_list) & set(destination_key_list))
-        missing_key_list = list(set(source_key_list) - set(destination_key_list))
+        return self.route_sources(source_list, destination_index)
 
-        self.logger.log("Found keys:")
-        self.logger.log(found_key_list)
-        self.logger.log("Missing keys:")
-        self.logger.log(missing_key_list)
+    def move_files(self, output_dirs: List[str] = None):
+        output_dirs = output_dirs if output_dirs is not None else [DIR_OUT]
+        self.logger.log_start(f"Moving files from {DIR_IN} to {', '.join(output_dirs)}")
+        executor = self.create_executor()
+        executor.recover()
+        start = time.perf_counter()
+        jobs, duplicates = self.find_duplicates(self.plan_moves(output_dirs))
+        self.logger.log(f"Planned {len(jobs)} moves in {time.perf_counter() - start:.2f}s")
+        self.quarantine_duplicates(duplicates)
+        executor.run(jobs)
 
-        for key_name in found_key_list:
-            destination_dir = [x.Path for x in destination_list if x.Key == key_name]
-            source_files = [x.Path for x in source_list if x.Key == key_name]
+        self.logger.log_end(f"Moving files from {DIR_IN} to {', '.join(output_dirs)}")
+
+        sys.stdout.flush()
 
-            for source_file in source_files:
-                destination_file = os.path.join(str(Path(destination_dir[0])), os.path.basename(source_file))
-                shutil.move(str(Path(source_file)), destination_file)
-                self.logger.log(f"Moved {source_file} to {destination_file}")
+    def write_plan(self, plan_path, output_dirs: List[str]):
+        # Calcola gli spostamenti senza toccare i file e li salva in formato JSON
+        self.logger.log_start(f"Planning moves to {plan_path}")
+        start = time.perf_counter()
+        jobs, duplicates = self.find_duplicates(self.plan_moves(output_dirs))
+        executor = self.create_executor()
+        moves = list()
+        for job in jobs:
+            try:
+                same_device = executor.is_same_device(job)
+            except OSError as e:
+                self.logger.log(f"Skipping {job.source}: {e}")
+                continue
+            moves.append({"source": job.source, "key": job.key, "destination": job.destination,
+                          "same_device": same_device, "size": job.size})
+        with open(plan_path, "w") as f:
+            json.dump({"version": VERSION, "output_dirs": output_dirs, "moves": moves,
+                       "duplicates": [{"source": source, "original": original} for source, original in duplicates]},
+                      f, indent=4)
+        self.logger.log(f"Planned {len(moves)} moves in {time.perf_counter() - start:.2f}s")
+        self.logger.log_end(f"Planning moves to {plan_path}")
 
-        self.logger.log_end(f"Moving files from {DIR_IN} to {dir_out}")
+    def apply_plan(self, plan_path):
+        self.logger.log_start(f"Applying moves from {plan_path}")
+        executor = self.create_executor()
+        executor.recover()
+        with open(plan_path) as f:
+            plan = json.load(f)
+        jobs: List[MoveJob] = list()
+        for move in plan["moves"]:
+            # Il piano può essere vecchio: i file spariti o modificati nel frattempo vengono saltati
+            try:
+                size = os.stat(move["source"]).st_size
+            except OSError:
+                self.logger.log(f"Skipping {move['source']}: file not found")
+                continue
+            if size != move["size"]:
+                self.logger.log(f"Skipping {move['source']}: size changed from {move['size']} to {size}")
+                continue
+            jobs.append(MoveJob(source=move["source"], destination=move["destination"], size=size, key=move["key"]))
+        self.quarantine_duplicates([(x["source"], x["original"]) for x in plan.get("duplicates", []) if
+                                    os.path.exists(x["source"]) and os.path.exists(x["original"])])
+        executor.run(jobs)
+        self.logger.log_end(f"Applying moves from {plan_path}")
+        sys.stdout.flush()
 
+    def move_paths(self, paths: List[str], output_dirs: List[str],
+                   indexes: Dict[str, Dict[str, List[Path]]], stable_seconds: float = None) -> List[str]:
+        # Sposta solo i file indicati e restituisce quelli rimandati perché ancora in scrittura.
+        # stable_seconds sostituisce StableSeconds, per esempio per i file di un torrent appena completato
+        source_list = [item for item in (self.make_source_item(path) for path in paths) if item is not None]
+        source_list, deferred = self.split_stable_sources(
+            self.skip_relocated_sources(self.skip_linked_sources(source_list)), stable_seconds)
+        if not source_list:
+            return [str(x.Path) for x in deferred]
+        title = f"Moving {len(source_list)} files from {DIR_IN}"
+        self.logger.log_start(title)
+        jobs = self.route_sources(source_list, self.merge_destination_indexes(output_dirs, indexes))
+        jobs, duplicates = self.find_duplicates(jobs)
+        self.quarantine_duplicates(duplicates)
+        self.create_executor().run(jobs)
+        self.logger.log_end(title)
         sys.stdout.flush()
+        return [str(x.Path) for x in deferred]
+
+    def update_destination_index(self, index: Dict[str, List[Path]], event: WatchEvent):
+        directory = Path(event.path)
+        if event.removed:
+            self.remove_destination_keys(index, directory)
+            self.logger.log(f"Removed {directory} from the destination index")
+        elif event.is_dir or directory.is_symlink():
+            self.add_destination_keys(index, directory)
+            self.logger.log(f"Added {directory} to the destination index")
+
+    def watch(self, output_dirs: List[str]):
+        self.logger.log_start("Watch")
+        self.move_files(output_dirs)
+        indexes = {output_dir: self.get_destination_index(output_dir) for output_dir in output_dirs}
+
+        watcher = create_watcher(self.logger, self.watch_poll_interval,
+                                 [(DIR_IN, True)] + [(output_dir, False) for output_dir in output_dirs])
+
+        # Percorso -> istante dell'ultimo evento: un file viene spostato solo dopo
+        # "watch_debounce" secondi senza nuove scritture
+        pending: Dict[str, float] = dict()
+        last_cleanup = time.monotonic()
+        try:
+            while True:
+                for event in watcher.read_events(timeout=1):
+                    now = time.monotonic()
+                    if event.overflow:
+                        self.logger.log("Watch events lost, rescanning everything")
+                        indexes = {output_dir: self.generate_destination_list(output_dir) for output_dir in
+                                   output_dirs}
+                        pending.update({str(x.Path): now for x in self.generate_source_list()})
+                    elif os.path.dirname(event.path) in indexes:
+                        self.update_destination_index(indexes[os.path.dirname(event.path)], event)
+                    elif event.removed:
+                        pending.pop(event.path, None)
+                    elif event.is_dir:
+                        pending.update({entry.path: now for entry in
+                                        self.scan_video_files(event.path, self.video_extensions)})
+                    elif os.path.splitext(event.path)[1].lower() in self.video_extensions:
+                        pending[event.path] = now
+
+                now = time.monotonic()
+                ready = [path for path, last in pending.items() if now - last >= self.watch_debounce]
+                for path in ready:
+                    del pending[path]
+                if ready:
+                    pending.update({path: now for path in self.move_paths(ready, output_dirs, indexes)})
+                if now - last_cleanup >= self.watch_cleanup_interval:
+                    # Le directory svuotate dagli spostamenti e i file collegati dei torrent rimossi vengono
+                    # eliminati come nell'esecuzione da cron
+                    if self.link_mode:
+                        self.cleanup_linked_sources()
+                    self.delete_small_directories(DIR_IN)
+                    last_cleanup = time.monotonic()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+        self.logger.log_end("Watch")
 
     def get_subdirectories_with_prefix(self, directory, prefix):
         subdirectories = []
@@ -164,12 +650,43 @@ class MoveVideo:
                     subdirectories.append(entry.path)
         return subdirectories
 
+    def get_output_dirs(self) -> List[str]:
+        # Ordine di precedenza delle directory di output: alfabetico (out, out1, out2, ...)
+        return sorted(self.get_subdirectories_with_prefix(DIR_OUT_ROOT, DIR_OUT_LABEL))
+
     def main(self):
         self.logger.log("Version: " + str(VERSION))
 
-        output_dirs = self.get_subdirectories_with_prefix(DIR_OUT_ROOT, DIR_OUT_LABEL)
-        for output_dir in output_dirs:
-            self.move_files(output_dir)
+        parser = argparse.ArgumentParser(description='Move video files into the directories matching their key')
+        parser.add_argument('--watch', action='store_true',
+                            help='Keep running and move new files as soon as they are completely written')
+        parser.add_argument('--list_small_directories', action='store_true',
+                            help='List the small directories that would be deleted, without moving or deleting')
+        parser.add_argument('--plan', type=str, help='Write the moves to a JSON plan file without moving anything')
+        parser.add_argument('--apply', type=str, help='Execute the moves of a JSON plan file')
+        args = parser.parse_args()
+
+        if args.list_small_directories:
+            self.delete_small_directories(DIR_IN, dry_run=True)
+            return
+
+        output_dirs = self.get_output_dirs()
+        if args.plan:
+            # Nessun file viene toccato, nemmeno le copie collegate da rimuovere
+            self.write_plan(args.plan, output_dirs)
+            return
+
+        if self.link_mode:
+            self.cleanup_linked_sources()
+
+        if args.apply:
+            self.apply_plan(args.apply)
+            return
+
+        if args.watch:
+            self.watch(output_dirs)
+            return
+        self.move_files(output_dirs)
         self.delete_small_directories(DIR_IN)
 
 
@@ -0,0 +1,337 @@
+import concurrent.futures
+import errno
+import fcntl
+import os
+import shutil
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import Dict, List
+
+from LinkLedger import LinkLedger
+from Log import Logger
+from MoveJournal import MoveJournal
+
+PARTIAL_SUFFIX = ".part"
+COPY_CHUNK = 8 * 1024 * 1024
+KERNEL_COPY_CHUNK = 128 * 1024 * 1024
+CHECKPOINT_BYTES = 256 * 1024 * 1024
+COPY_METHODS = ["copy_file_range", "sendfile", "read_write"]
+# Errors meaning "not supported here": the next copy method is tried
+FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTSUP}
+FICLONE = getattr(fcntl, "FICLONE", 0x40049409)
+
+
+@dataclass
+class MoveJob:
+    source: str
+    destination: str
+    size: int = 0
+    key: str = ""
+
+
+@dataclass
+class MoveResult:
+    job: MoveJob
+    device: int
+    method: str = ""  # "rename" on the same device, otherwise the copy method ("copy_file_range", ...) or link
+    error: str = ""
+    elapsed: float = 0.0
+
+
+class MoveExecutor:
+    """
+    Moves files with one worker queue per destination device.
+
+    Moves on the same device are a plain os.rename; cross-device moves are full copies, so a
+    slow copy to one device does not block the moves towards the other devices.
+    Copies are written to a temporary name and renamed when complete; with a journal they
+    can be resumed after a crash from the last offset synced to disk.
+    With a link ledger the files are linked (hardlink or reflink) instead of moved, so the
+    source stays in place for seeding and no data is copied.
+    """
+
+    def __init__(self, logger: Logger, concurrency: int = 1, journal: MoveJournal = None,
+                 link_ledger: LinkLedger = None):
+        self.logger = logger
+        self.concurrency = max(1, concurrency)
+        self.journal = journal
+        self.link_ledger = link_ledger
+
+    def destination_device(self, job: MoveJob) -> int:
+        return os.stat(os.path.dirname(job.destination) or ".").st_dev
+
+    def is_same_device(self, job: MoveJob) -> bool:
+        # Solo un'indicazione: tra bind mount diversi dello stesso filesystem lo st_dev è uguale,
+        # ma il rename fallisce e il file viene copiato
+        return os.stat(job.source).st_dev == self.destination_device(job)
+
+    def make_temp(self, job: MoveJob) -> str:
+        # Nome temporaneo univoco nella directory di destinazione: due copie non scrivono mai sullo stesso file
+        fd, temp = tempfile.mkstemp(prefix="." + os.path.basename(job.destination) + ".", suffix=PARTIAL_SUFFIX,
+                                    dir=os.path.dirname(job.destination) or ".")
+        os.close(fd)
+        return temp
+
+    def rename_no_replace(self, source: str, destination: str):
+        # Un file già presente nella directory di destinazione non viene mai sovrascritto
+        if os.path.lexists(destination):
+            raise FileExistsError(errno.EEXIST, f"{destination} already exists")
+        os.rename(source, destination)
+
+    def move(self, job: MoveJob, device: int) -> MoveResult:
+        result = MoveResult(job=job, device=device)
+        start = time.perf_counter()
+        try:
+            stat = os.stat(job.source)
+            if job.size and stat.st_size != job.size:
+                # Il file è cambiato dopo la pianificazione: è ancora in scrittura
+                result.error = f"size changed from {job.size} to {stat.st_size}"
+                self.logger.log(f"Deferred {job.source}: {result.error}")
+                return result
+            if self.link_ledger is not None:
+                result.method = self.link(job, stat.st_dev == device)
+                self.link_ledger.add(job.source, job.destination, result.method)
+            elif stat.st_dev == device:
+                result.method = self.rename_move(job)
+            else:
+                result.method = self.copy_move(job)
+            self.logger.log(f"{'Linked' if self.link_ledger is not None else 'Moved'} {job.source} to "
+                            f"{job.destination} ({result.method})")
+        except OSError as e:
+            result.error = str(e)
+            self.logger.log(f"Error moving {job.source} to {job.destination}: {e}")
+        result.elapsed = time.perf_counter() - start
+        return result
+
+    def rename_move(self, job: MoveJob) -> str:
+        # Lo stesso st_dev non basta: tra due bind mount dello stesso filesystem (per esempio i VOLUME
+        # /app/in e /app/out) os.rename fallisce con EXDEV e il file viene copiato
+        try:
+            self.rename_no_replace(job.source, job.destination)
+            return "rename"
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+        return self.copy_move(job)
+
+    def link(self, job: MoveJob, same_device: bool) -> str:
+        # Hardlink sullo stesso device, altrimenti reflink (stesso filesystem su mount diversi, anche bind
+        # mount con lo stesso st_dev, dove os.link fallisce con EXDEV): in nessun caso vengono copiati dati
+        if same_device:
+            try:
+                os.link(job.source, job.destination)
+                return "hardlink"
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+        if os.path.lexists(job.destination):
+            raise FileExistsError(errno.EEXIST, f"{job.destination} already exists")
+        temp = self.make_temp(job)
+        try:
+            source_fd = os.open(job.source, os.O_RDONLY)
+            try:
+                destination_fd = os.open(temp, os.O_WRONLY | os.O_TRUNC)
+                try:
+                    linked = self.reflink(source_fd, destination_fd)
+                finally:
+                    os.close(destination_fd)
+            finally:
+                os.close(source_fd)
+            if not linked:
+                raise OSError(errno.EXDEV, "hardlink and reflink not possible between these filesystems")
+            shutil.copystat(job.source, temp)
+            self.rename_no_replace(temp, job.destination)
+        except OSError:
+            os.remove(temp)
+            raise
+        return "reflink"
+
+    def copy_move(self, job: MoveJob, temp: str = None, offset: int = 0) -> str:
+        # Copia su un file temporaneo, rename atomico sul nome finale e solo alla fine rimozione della sorgente.
+        # Restituisce il metodo usato per copiare i dati
+        size = os.stat(job.source).st_size
+        if os.path.lexists(job.destination):
+            raise FileExistsError(errno.EEXIST, f"{job.destination} already exists")
+        if temp is None:
+            temp = self.make_temp(job)
+            if self.journal:
+                self.journal.begin(job.source, job.destination, temp, size)
+        try:
+            source_fd = os.open(job.source, os.O_RDONLY)
+            try:
+                destination_fd = os.open(temp, os.O_WRONLY | os.O_CREAT, 0o644)
+                try:
+                    os.ftruncate(destination_fd, offset)
+                    method = self.copy_data(job, temp, source_fd, destination_fd, offset, size)
+                    os.fsync(destination_fd)
+                finally:
+                    os.close(destination_fd)
+            finally:
+                os.close(source_fd)
+            copied = os.path.getsize(temp)
+            if copied != size:
+                raise OSError(errno.EIO, f"{temp} has {copied} bytes instead of {size}")
+            shutil.copystat(job.source, temp)
+            self.rename_no_replace(temp, job.destination)
+        except OSError:
+            # Senza journal la copia non può essere ripresa: il file temporaneo viene rimosso
+            if not self.journal and os.path.exists(temp):
+                os.remove(temp)
+            raise
+        self.sync_directory(os.path.dirname(job.destination))
+        os.remove(job.source)
+        if self.journal:
+            self.journal.done(job.source, temp)
+        return method
+
+    def copy_data(self, job: MoveJob, temp: str, source_fd: int, destination_fd: int, offset: int, size: int) -> str:
+        # Metodi in ordine di preferenza: reflink (nessun dato copiato), copy_file_range e sendfile
+        # (copia nel kernel), read/write a blocchi grandi. Si passa al successivo quando il
+        # filesystem o il kernel non supportano quello corrente
+        if offset == 0 and size > 0 and self.reflink(source_fd, destination_fd):
+            return "reflink"
+        methods = [method for method in COPY_METHODS if method == "read_write" or hasattr(os, method)]
+        synced = offset
+        while offset < size:
+            try:
+                copied = self.copy_chunk(methods[0], source_fd, destination_fd, offset, size - offset)
+            except OSError as e:
+                if e.errno not in FALLBACK_ERRNOS or len(methods) == 1:
+                    raise
+                methods.pop(0)
+                continue
+            if copied == 0:
+                # Sorgente accorciata durante la copia: il file temporaneo resta incompleto e la sorgente non
+                # viene rimossa
+                raise OSError(errno.EIO, f"{job.source} truncated at {offset} of {size} bytes")
+            offset += copied
+            if self.journal and offset - synced >= CHECKPOINT_BYTES:
+                os.fsync(destination_fd)
+                self.journal.checkpoint(job.source, temp, offset)
+                synced = offset
+        return methods[0]
+
+    def reflink(self, source_fd: int, destination_fd: int) -> bool:
+        try:
+            fcntl.ioctl(destination_fd, FICLONE, source_fd)
+            return True
+        except OSError:
+            return False
+
+    def copy_chunk(self, method: str, source_fd: int, destination_fd: int, offset: int, remaining: int) -> int:
+        if method == "copy_file_range":
+            return os.copy_file_range(source_fd, destination_fd, min(remaining, KERNEL_COPY_CHUNK), offset, offset)
+        if method == "sendfile":
+            os.lseek(destination_fd, offset, os.SEEK_SET)
+            return os.sendfile(destination_fd, source_fd, offset, min(remaining, KERNEL_COPY_CHUNK))
+        data = os.pread(source_fd, min(remaining, COPY_CHUNK), offset)
+        return os.pwrite(destination_fd, data, offset)
+
+    def sync_directory(self, directory: str):
+        fd = os.open(directory or ".", os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def recover(self):
+        # Completa gli spostamenti interrotti da un crash, riprendendo le copie dall'ultimo offset verificato
+        if not self.journal:
+            return
+        for (source, temp), entry in self.journal.pending().items():
+            destination = entry["destination"]
+            job = MoveJob(source=source, destination=destination, size=entry["size"])
+            try:
+                if not os.path.exists(source):
+                    # Crash dopo la rimozione della sorgente: lo spostamento era già completo, resta solo da
+                    # eliminare un eventuale file temporaneo orfano
+                    if os.path.exists(temp):
+                        os.remove(temp)
+                    self.logger.log(f"Recovered move {source} to {destination}: already completed")
+                elif os.path.exists(temp) and os.path.lexists(destination):
+                    # La destinazione non è il file temporaneo di questo spostamento: non viene mai sovrascritta
+                    os.remove(temp)
+                    self.logger.log(f"Abandoned move {source} to {destination}: destination already exists")
+                elif os.path.exists(destination):
+                    # Crash tra il rename e la rimozione della sorgente (il file temporaneo è già stato rinominato)
+                    if os.path.getsize(destination) == os.path.getsize(source):
+                        os.remove(source)
+                        self.logger.log(f"Recovered move {source} to {destination}: source removed")
+                    else:
+                        self.logger.log(f"Abandoned move {source} to {destination}: destination already exists")
+                elif os.path.exists(temp) and os.path.getsize(source) == entry["size"]:
+                    offset = min(entry["offset"], os.path.getsize(temp))
+                    self.logger.log(f"Resuming copy of {source} to {destination} from offset {offset}")
+                    method = self.copy_move(job, temp, offset)
+                    self.logger.log(f"Recovered move {source} to {destination} ({method})")
+                    continue
+                else:
+                    # Sorgente modificata dopo il crash: la copia riparte da zero in un nuovo file temporaneo
+                    if os.path.exists(temp):
+                        os.remove(temp)
+                    self.logger.log(f"Restarting copy of {source} to {destination}")
+                    self.journal.done(source, temp)
+                    method = self.copy_move(job)
+                    self.logger.log(f"Recovered move {source} to {destination} ({method})")
+                    continue
+                self.journal.done(source, temp)
+            except OSError as e:
+                self.logger.log(f"Error recovering move {source} to {destination}: {e}")
+        self.journal.compact()
+
+    def run(self, jobs: List[MoveJob]) -> List[MoveResult]:
+        results: List[MoveResult] = list()
+        jobs_by_device: Dict[int, List[MoveJob]] = dict()
+        # Due sorgenti con lo stesso nome dirette nella stessa directory: viene spostata solo la prima,
+        # le altre restano dove sono
+        destinations: Dict[str, MoveJob] = dict()
+        for job in jobs:
+            destination = os.path.normpath(os.path.abspath(job.destination))
+            if destination in destinations:
+                error = f"same destination as {destinations[destination].source}"
+                self.logger.log(f"Skipping {job.source}: {error}")
+                results.append(MoveResult(job=job, device=-1, error=error))
+                continue
+            destinations[destination] = job
+            try:
+                jobs_by_device.setdefault(self.destination_device(job), []).append(job)
+            except OSError as e:
+                self.logger.log(f"Error moving {job.source} to {job.destination}: {e}")
+                results.append(MoveResult(job=job, device=-1, error=str(e)))
+
+        start = time.perf_counter()
+        executors = [concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) for _ in jobs_by_device]
+        try:
+            futures = [executor.submit(self.move, job, device) for executor, (device, device_jobs) in
+                       zip(executors, jobs_by_device.items()) for job in device_jobs]
+            for future in concurrent.futures.as_completed(futures):
+                results.append(future.result())
+        finally:
+            for executor in executors:
+                executor.shutdown()
+            if self.link_ledger is not None:
+                self.link_ledger.save()
+        self.log_throughput(results, time.perf_counter() - start)
+        return results
+
+    def log_throughput(self, results: List[MoveResult], elapsed: float):
+        devices: Dict[int, List[MoveResult]] = dict()
+        for result in results:
+            if not result.error:
+                devices.setdefault(result.device, []).append(result)
+        for device, device_results in devices.items():
+            self.logger.log(f"Device {device}: " + self.format_throughput(device_results, elapsed))
+        done = [result for result in results if not result.error]
+        self.logger.log(f"Moved {len(done)}/{len(results)} files: " + self.format_throughput(done, elapsed))
+        methods: Dict[str, int] = dict()
+        for result in done:
+            methods[result.method] = methods.get(result.method, 0) + 1
+        if methods:
+            self.logger.log(f"Move methods: {methods}")
+
+    def format_throughput(self, results: List[MoveResult], elapsed: float) -> str:
+        total_bytes = sum(result.job.size for result in results)
+        elapsed = max(elapsed, 1e-6)
+        return (f"{total_bytes} bytes in {elapsed:.2f}s ({total_bytes / elapsed:.0f} bytes/s, "
+                f"{len(results) / elapsed:.2f} files/s)")
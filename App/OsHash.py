@@ -0,0 +1,73 @@
+import os
+import sqlite3
+import struct
+from typing import Dict, Optional, Set
+
+CHUNK_SIZE = 64 * 1024
+
+
+def oshash(path: str) -> Optional[str]:
+    """
+    Stash compatible oshash: file size plus the sum of the first and last 64 KB read as
+    little-endian uint64 words, modulo 2^64, as 16 hex digits. None for empty files.
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return None
+    chunk = min(CHUNK_SIZE, size)
+    with open(path, "rb") as f:
+        head = f.read(chunk)
+        f.seek(size - chunk)
+        tail = f.read(chunk)
+    data = head + tail
+    words = len(data) // 8
+    total = (sum(struct.unpack(f"<{words}Q", data[:words * 8])) + size) & 0xFFFFFFFFFFFFFFFF
+    return f"{total:016x}"
+
+
+class OsHashIndex:
+    """Cache of the oshash of the files in the destination directories, invalidated by size and mtime."""
+
+    def __init__(self, db_path: str):
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, oshash TEXT)")
+        self.connection.commit()
+        self.directories: Dict[str, Dict[str, str]] = dict()  # directory -> oshash -> file, for this run
+
+    def file_hash(self, path: str, stat: os.stat_result) -> Optional[str]:
+        row = self.connection.execute("SELECT size, mtime_ns, oshash FROM hashes WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+        value = oshash(path)
+        self.connection.execute("INSERT OR REPLACE INTO hashes (path, size, mtime_ns, oshash) VALUES (?, ?, ?, ?)",
+                                (path, stat.st_size, stat.st_mtime_ns, value))
+        return value
+
+    def directory_hashes(self, directory: str, extensions: Set[str]) -> Dict[str, str]:
+        # oshash -> file of every video file in the directory (and its subdirectories)
+        directory = os.path.abspath(directory)
+        if directory not in self.directories:
+            hashes: Dict[str, str] = dict()
+            for root, _, files in os.walk(directory):
+                for name in files:
+                    if os.path.splitext(name)[1].lower() not in extensions:
+                        continue
+                    path = os.path.join(root, name)
+                    try:
+                        value = self.file_hash(path, os.stat(path))
+                    except OSError:
+                        continue
+                    if value is not None:
+                        hashes.setdefault(value, path)
+            self.connection.commit()
+            self.directories[directory] = hashes
+        return self.directories[directory]
+
+    def add(self, directory: str, value: str, path: str):
+        # File about to be moved into the directory: duplicates of it in the same run are found too
+        self.directories.setdefault(os.path.abspath(directory), dict()).setdefault(value, path)
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
@@ -1,15 +1,48 @@
 import configparser
+import gzip
+import hashlib
 import os
+import random
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
 import feedgenerator
-from flask import Flask
-import schedule
+from flask import Flask, request
 import re
 from dataclasses import dataclass
-from typing import List
+from html.parser import HTMLParser
+from typing import Dict, List
+
+try:
+    # requests decomprime le risposte "br" solo se brotli è installato
+    import brotli  # noqa: F401
+
+    ACCEPT_ENCODING = "gzip, deflate, br"
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
+
+# Ogni aggiornamento del feed parte dopo Interval minuti ± 10%
+REFRESH_JITTER = 0.1
+SCRAPE_CONCURRENCY = 4
+SCRAPE_RATE = 1.0
+SCRAPE_BURST = 1
+
+HEADERS = {
+    "accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,"
+              "application/signed-exchange;v=b3;q=0.7",
+    "accept-encoding": ACCEPT_ENCODING,
+    "accept-language": "en-US,en;q=0.9,it-IT;q=0.8,it;q=0.7,es-ES;q=0.6,es;q=0.5,pt-BR;q=0.4,pt;q=0.3",
+    "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+                  "Chrome/130.0.0.0 Safari/537.36 Edg/130.0.0.0"
+}
+
+sessions: Dict[str, requests.Session] = dict()
+sessions_lock = threading.Lock()
 
 
 @dataclass
@@ -27,26 +60,173 @@ class Server:
     column_title: int
     interval: int
     port: int
+    concurrency: int = SCRAPE_CONCURRENCY
+    rate: float = SCRAPE_RATE
+    burst: int = SCRAPE_BURST
+
+
+class TokenBucket:
+    """Limita le richieste verso un host: "rate" richieste al secondo, al massimo "burst" consecutive"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def get_session(host: str, pool_size: int = SCRAPE_CONCURRENCY) -> requests.Session:
+    # Una sessione per host condivisa da tutti gli Scraper: le connessioni keep-alive (e il TLS) vengono riusate.
+    # Il pool deve contenere una connessione per ogni richiesta in parallelo, altrimenti urllib3 chiude quelle in più
+    with sessions_lock:
+        if host not in sessions:
+            session = requests.Session()
+            session.headers.update(HEADERS)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size))
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            sessions[host] = session
+        return sessions[host]
+
+
+# Tag senza chiusura: come in BeautifulSoup non contengono altri elementi
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem', 'meta',
+             'param', 'source', 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame', 'image', 'isindex',
+             'nextid', 'spacer'}
+
+
+class TableCell:
+    def __init__(self):
+        self.strings: List[str] = []
+        self.magnet = None
+
+
+class StopParsing(Exception):
+    pass
+
+
+class MagnetTableParser(HTMLParser):
+    """
+    Estrae righe e celle del primo <tbody> leggendo l'HTML in streaming, senza costruire l'albero del documento,
+    e si ferma alla sua chiusura. Replica la logica di BeautifulSoup usata da Scraper.parse_soup: le righe e le
+    celle sono tutti i <tr> e <td> discendenti, il testo di una cella è quello di get_text(strip=True) e il link
+    è il primo <a> con href "magnet:".
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.found = False
+        self.outer: List[str] = []  # tag aperti prima del <tbody>
+        self.stack: List[tuple] = []  # (tag, TableCell o lista delle celle di un <tr>)
+        self.rows: List[List[TableCell]] = []
+        self.data: List[str] = []
+
+    def flush(self):
+        # Come BeautifulSoup, il testo tra due tag è una sola stringa, ripulita dagli spazi solo alle estremità
+        if self.data:
+            text = "".join(self.data).strip()
+            self.data = []
+            if text:
+                for tag, element in self.stack:
+                    if tag == 'td':
+                        element.strings.append(text)
+
+    def handle_starttag(self, tag, attrs):
+        if not self.found:
+            if tag == 'tbody':
+                self.found = True
+                self.stack.append((tag, None))
+            elif tag not in VOID_TAGS:
+                self.outer.append(tag)
+            return
+        self.flush()
+        element = None
+        if tag == 'tr':
+            element = []
+            self.rows.append(element)
+        elif tag == 'td':
+            element = TableCell()
+            for open_tag, row in self.stack:
+                if open_tag == 'tr':
+                    row.append(element)
+        elif tag == 'a':
+            href = dict(attrs).get('href')
+            if href is not None and href.startswith('magnet:'):
+                for open_tag, cell in self.stack:
+                    if open_tag == 'td' and cell.magnet is None:
+                        cell.magnet = href
+        if tag not in VOID_TAGS:
+            self.stack.append((tag, element))
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        # Chiude l'ultimo elemento aperto con lo stesso nome e quelli al suo interno; i tag non aperti sono ignorati
+        if not self.found:
+            if tag in self.outer:
+                del self.outer[len(self.outer) - 1 - self.outer[::-1].index(tag):]
+            return
+        self.flush()
+        for i in range(len(self.stack) - 1, -1, -1):
+            if self.stack[i][0] == tag:
+                del self.stack[i:]
+                break
+        else:
+            if tag in self.outer:
+                # Chiusura di un elemento che contiene il <tbody> (per esempio </table> senza </tbody>)
+                del self.stack[:]
+        if not self.stack:
+            raise StopParsing()
+
+    def handle_data(self, data):
+        if self.stack and self.stack[-1][0] not in ('script', 'style'):
+            self.data.append(data)
+
+    def handle_comment(self, data):
+        self.flush()
 
 
 class Scraper:
-    def __init__(self, url: str, column_magnet_link: int = 2, column_description: int = 1):
+    def __init__(self, url: str, column_magnet_link: int = 2, column_description: int = 1,
+                 bucket: TokenBucket = None, pool_size: int = SCRAPE_CONCURRENCY):
         self.url = url
         self.column_magnet_link = column_magnet_link
         self.column_description = column_description
+        self.bucket = bucket
+        self.pool_size = pool_size
+        self.etag = None
+        self.last_modified = None
+        self.magnet_links: List[MagnetLink] = []
 
     def scrape(self) -> List[MagnetLink]:
-        magnet_links = []
-        session = requests.session()
-        session.headers[
-            "accept"] = "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7"
-        session.headers[
-            "accept-language"] = "en-US,en;q=0.9,it-IT;q=0.8,it;q=0.7,es-ES;q=0.6,es;q=0.5,pt-BR;q=0.4,pt;q=0.3"
-        session.headers[
-            "user-agent"] = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/130.0.0.0 Safari/537.36 Edg/130.0.0.0"
+        # Richiesta condizionale: se la pagina non è cambiata (304) vengono riusati i link già letti
+        session = get_session(urlparse(self.url).netloc, self.pool_size)
+        headers = {}
+        if self.etag:
+            headers["if-none-match"] = self.etag
+        if self.last_modified:
+            headers["if-modified-since"] = self.last_modified
         for attempt in range(10):
             try:
-                response = session.get(self.url)
+                if self.bucket is not None:
+                    self.bucket.acquire()
+                response = session.get(self.url, headers=headers)
                 response.raise_for_status()  # Solleva un'eccezione per errori HTTP
                 break  # Esce dal ciclo se l'operazione ha successo
             except requests.RequestException as e:
@@ -56,7 +236,41 @@ class Scraper:
                 else:
                     print("Numero massimo di tentativi raggiunto. Operazione fallita.")
                     raise  # Rilancia l'eccezione se tutti i tentativi falliscono
-        soup = BeautifulSoup(response.text, 'html.parser')
+        if response.status_code == 304:
+            return list(self.magnet_links)
+        magnet_links = self.parse(response.text)
+        # Una pagina senza link (per esempio una pagina di errore del proxy) non viene mai riusata
+        self.etag = response.headers.get("etag") if magnet_links else None
+        self.last_modified = response.headers.get("last-modified") if magnet_links else None
+        self.magnet_links = magnet_links
+        return list(magnet_links)
+
+    def parse(self, html: str) -> List[MagnetLink]:
+        magnet_links = []
+        parser = MagnetTableParser()
+        try:
+            parser.feed(html)
+            parser.close()
+        except StopParsing:
+            pass
+        parser.flush()
+        if not parser.found:
+            print("Error: Could not find 'tbody' element in the HTML")
+            return magnet_links
+        for cells in parser.rows:
+            if len(cells) >= 2:
+                magnet = cells[self.column_magnet_link].magnet
+                if magnet:
+                    magnet_links.append(MagnetLink(
+                        url=magnet,
+                        description="".join(cells[self.column_description].strings)
+                    ))
+        return magnet_links
+
+    def parse_soup(self, html: str) -> List[MagnetLink]:
+        # Versione con BeautifulSoup, più lenta: usata come riferimento da BenchmarkScraper
+        magnet_links = []
+        soup = BeautifulSoup(html, 'html.parser')
 
         # FInd the root path
         table = soup.find('tbody')
@@ -96,49 +310,96 @@ class RSSGenerator:
     def get_feed(self) -> str:
         return self.feed.writeString('utf-8')
 
+    def render(self):
+        # Il feed viene serializzato, compresso e identificato (ETag) una sola volta per aggiornamento
+        self.body = self.get_feed().encode('utf-8')
+        self.gzip_body = gzip.compress(self.body, mtime=0)
+        self.etag = hashlib.sha256(self.body).hexdigest()[:32]
+
 
 class App:
-    def __init__(self, title: str, url: str, column_magnet_link: int, column_title: int, link_number=1, port=55101):
+    def __init__(self, title: str, url: str, column_magnet_link: int, column_title: int, link_number=1, port=55101,
+                 concurrency=SCRAPE_CONCURRENCY, rate=SCRAPE_RATE, burst=SCRAPE_BURST):
         self.title = title
         self.port = port
         urls = [f"{url}{i}" for i in range(1, link_number + 1)]
-        self.scrapers = [Scraper(url, column_magnet_link=column_magnet_link, column_description=column_title) for
-                         url in urls]
+        # Un token bucket per host, condiviso dalle pagine dello stesso host
+        buckets = {host: TokenBucket(rate, burst) for host in {urlparse(url).netloc for url in urls}}
+        self.scrapers = [Scraper(url, column_magnet_link=column_magnet_link, column_description=column_title,
+                                 bucket=buckets[urlparse(url).netloc], pool_size=concurrency) for url in urls]
+        self.pool = ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(self.scrapers))),
+                                       thread_name_prefix="Scraper")
         self.rss_generator = RSSGenerator(
             title=self.title,
             link="",
             description=""
         )
+        self.rss_generator.render()
+        self.links: List[MagnetLink] = []
         self.app = Flask(__name__)
+        self.stop_event = threading.Event()
 
     def run(self, interval: int = 30):
         self.update_feed()
-        schedule.every(interval).minutes.do(self.update_feed)
+        # Il feed viene aggiornato in background: le richieste ricevono sempre l'ultimo feed valido
+        refresher = threading.Thread(target=self.refresh_loop, args=(interval * 60,), name="FeedRefresher",
+                                     daemon=True)
+        refresher.start()
 
         @self.app.route('/')
         def serve_rss():
-            return self.rss_generator.get_feed(), 200, {'Content-Type': 'application/rss+xml'}
+            # Nessuna serializzazione per richiesta: 304 se il client ha già questo feed, altrimenti i byte
+            # già pronti (compressi se il client accetta gzip)
+            feed = self.rss_generator
+            headers = {'Content-Type': 'application/rss+xml', 'ETag': f'"{feed.etag}"', 'Vary': 'Accept-Encoding'}
+            if request.if_none_match.contains_weak(feed.etag):
+                return b'', 304, headers
+            if request.accept_encodings['gzip'] > 0:
+                headers['Content-Encoding'] = 'gzip'
+                return feed.gzip_body, 200, headers
+            return feed.body, 200, headers
 
         self.app.run(host='0.0.0.0', port=self.port)
 
-    def update_feed(self):
+    def refresh_loop(self, interval: float):
+        while not self.stop_event.wait(interval * random.uniform(1 - REFRESH_JITTER, 1 + REFRESH_JITTER)):
+            self.update_feed()
+
+    def update_feed(self) -> bool:
+        # In caso di errore (o di pagine senza link) resta il feed precedente
         all_links = []
-        for scraper in self.scrapers:
-            all_links.extend(scraper.scrape())
-            time.sleep(1)
+        try:
+            # Le pagine vengono lette in parallelo, al ritmo consentito dal token bucket del loro host;
+            # l'ordine dei link resta quello delle pagine
+            for links in self.pool.map(lambda scraper: scraper.scrape(), self.scrapers):
+                all_links.extend(links)
+        except Exception as e:
+            print(f"Aggiornamento del feed fallito, resta il feed precedente: {e}")
+            return False
+        if not all_links:
+            print("Nessun link trovato, resta il feed precedente")
+            return False
+        if all_links == self.links:
+            # Stessi link: il feed (e quindi l'ETag) non cambia, anche se la data di generazione sarebbe nuova
+            return True
 
-        self.rss_generator = RSSGenerator(
+        # Il nuovo feed viene completato prima di sostituire quello servito
+        rss_generator = RSSGenerator(
             title=self.title,
             link="",
             description=""
         )
 
         for link in all_links:
-            self.rss_generator.add_item(
+            rss_generator.add_item(
                 title=link.description,
                 link=link.url,
                 description=link.description
             )
+        rss_generator.render()
+        self.rss_generator = rss_generator
+        self.links = all_links
+        return True
 
 
 def parse_config():
@@ -157,11 +418,15 @@ def initialize() -> Server:
         column_magnet=int(server_config["Column_magnet"]),
         column_title=int(server_config["Column_title"]),
         link_number=int(server_config["Link_number"]),
-        port=int(server_config["Port"]))
+        port=int(server_config["Port"]),
+        concurrency=server_config.getint("Concurrency", fallback=SCRAPE_CONCURRENCY),
+        rate=server_config.getfloat("Rate", fallback=SCRAPE_RATE),
+        burst=server_config.getint("Burst", fallback=SCRAPE_BURST))
     return server
 
 
 if __name__ == '__main__':
     server = initialize()
-    app = App(server.title, server.url, server.column_magnet, server.column_title, server.link_number, server.port)
+    app = App(server.title, server.url, server.column_magnet, server.column_title, server.link_number, server.port,
+              server.concurrency, server.rate, server.burst)
     app.run(interval=server.interval)
@@ -0,0 +1,86 @@
+import bisect
+import json
+import os
+from typing import Dict, Iterable, List
+
+
+class TorrentSnapshot:
+    """
+    The torrents of qBittorrent, fetched once per run and kept up to date with sync/maindata.
+
+    qBittorrent answers sync/maindata with only what changed since the response id ("rid") of the previous
+    call, so the torrents and the rid are saved to disk and the next run transfers just the delta. When the
+    server does not know the rid any more (restart, new session) it sends a full update instead.
+    Torrents are plain dicts (hash -> sync/maindata fields, plus "hash"), indexed by state and content path.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.rid = 0
+        self.torrents: Dict[str, dict] = dict()
+        self.states: Dict[str, List[dict]] = dict()
+        self.content_paths: List[tuple] = list()  # (content_path, hash), sorted
+        self.completed: List[str] = list()  # hashes of the torrents completed since the previous refresh
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+                self.rid = data["rid"]
+                self.torrents = data["torrents"]
+            except (OSError, ValueError, KeyError):
+                # Corrupted snapshot: the next refresh is a full update
+                self.rid = 0
+                self.torrents = dict()
+
+    def refresh(self, client) -> dict:
+        # Applies the delta since the last rid and returns the raw sync/maindata response
+        data = client.sync_maindata(rid=self.rid)
+        progress = {torrent_hash: torrent.get("progress", 0) for torrent_hash, torrent in self.torrents.items()}
+        if data.get("full_update"):
+            self.torrents = dict()
+        for torrent_hash, fields in (data.get("torrents") or {}).items():
+            self.torrents.setdefault(torrent_hash, {"hash": torrent_hash}).update(fields)
+        for torrent_hash in data.get("torrents_removed") or []:
+            self.torrents.pop(torrent_hash, None)
+        self.rid = data.get("rid", 0)
+        self.completed = [torrent_hash for torrent_hash in (data.get("torrents") or {}) if
+                          torrent_hash in self.torrents and self.torrents[torrent_hash].get("progress", 0) >= 1 and
+                          progress.get(torrent_hash, 0) < 1]
+        self.build_indexes()
+        return data
+
+    def build_indexes(self):
+        self.states = dict()
+        for torrent in self.torrents.values():
+            self.states.setdefault(torrent.get("state"), []).append(torrent)
+        self.content_paths = sorted((torrent.get("content_path", ""), torrent_hash) for torrent_hash, torrent in
+                                    self.torrents.items())
+
+    def remove(self, torrent_hashes: Iterable[str]):
+        # Torrents deleted by this run: the next delta would report them anyway
+        for torrent_hash in torrent_hashes:
+            self.torrents.pop(torrent_hash, None)
+        self.build_indexes()
+
+    def with_states(self, states: Iterable[str]) -> List[dict]:
+        return [torrent for state in states for torrent in self.states.get(state, [])]
+
+    def under(self, prefix: str) -> List[dict]:
+        # Torrents whose content path starts with "prefix", found with a binary search
+        result = list()
+        for content_path, torrent_hash in self.content_paths[bisect.bisect_left(self.content_paths, (prefix,)):]:
+            if not content_path.startswith(prefix):
+                break
+            result.append(self.torrents[torrent_hash])
+        return result
+
+    def counters(self) -> Dict[str, int]:
+        return {state: len(torrents) for state, torrents in self.states.items()}
+
+    def save(self):
+        if not self.path:
+            return
+        temp = self.path + ".tmp"
+        with open(temp, "w") as f:
+            json.dump({"rid": self.rid, "torrents": self.torrents}, f)
+        os.replace(temp, self.path)
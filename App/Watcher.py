@@ -0,0 +1,169 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+from Log import Logger
+
+# inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct("iIII")
+
+
+@dataclass
+class WatchEvent:
+    path: str
+    is_dir: bool = False
+    removed: bool = False  # deleted or moved away
+    overflow: bool = False  # events were lost: the caller has to rescan everything
+
+
+class InotifyWatcher:
+    """Watches directories with the Linux inotify API (through libc, no extra dependency)."""
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches: Dict[int, Tuple[str, bool]] = dict()  # watch descriptor -> (path, recursive)
+
+    def watch(self, path: str, recursive: bool = False):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+        self.watches[wd] = (path, recursive)
+        if recursive:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        self.watch(entry.path, recursive)
+
+    def read_events(self, timeout: float) -> List[WatchEvent]:
+        events: List[WatchEvent] = list()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return events
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return events
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0"))
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                events.append(WatchEvent(path="", overflow=True))
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches:
+                continue
+            directory, recursive = self.watches[wd]
+            event = WatchEvent(path=os.path.join(directory, name), is_dir=bool(mask & IN_ISDIR),
+                               removed=bool(mask & (IN_DELETE | IN_MOVED_FROM)))
+            if recursive and event.is_dir and not event.removed:
+                try:
+                    self.watch(event.path, recursive)
+                except OSError:
+                    pass
+            events.append(event)
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Fallback watcher: compares a snapshot of the watched directories every "interval" seconds."""
+
+    def __init__(self, interval: float = 60):
+        self.interval = interval
+        self.roots: List[Tuple[str, bool]] = list()
+        self.snapshot: Dict[str, Tuple[bool, int, int]] = dict()
+        self.last_poll = 0.0
+
+    def watch(self, path: str, recursive: bool = False):
+        self.roots.append((path, recursive))
+        self.snapshot.update(self.scan(path, recursive))
+        self.last_poll = time.monotonic()
+
+    def scan(self, path: str, recursive: bool) -> Dict[str, Tuple[bool, int, int]]:
+        result: Dict[str, Tuple[bool, int, int]] = dict()
+        pending = [path]
+        while pending:
+            current = pending.pop()
+            try:
+                with os.scandir(current) as it:
+                    for entry in it:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                        if is_dir:
+                            result[entry.path] = (True, 0, 0)
+                            if recursive:
+                                pending.append(entry.path)
+                        else:
+                            stat = entry.stat(follow_symlinks=False)
+                            result[entry.path] = (False, stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                pass
+        return result
+
+    def read_events(self, timeout: float) -> List[WatchEvent]:
+        remaining = self.last_poll + self.interval - time.monotonic()
+        if remaining > 0:
+            time.sleep(min(timeout, remaining))
+            return []
+        self.last_poll = time.monotonic()
+        snapshot: Dict[str, Tuple[bool, int, int]] = dict()
+        for path, recursive in self.roots:
+            snapshot.update(self.scan(path, recursive))
+        events = [WatchEvent(path=path, is_dir=state[0]) for path, state in snapshot.items() if
+                  self.snapshot.get(path) != state]
+        events.extend(WatchEvent(path=path, is_dir=state[0], removed=True) for path, state in self.snapshot.items()
+                      if path not in snapshot)
+        self.snapshot = snapshot
+        return events
+
+    def close(self):
+        pass
+
+
+def create_watcher(logger: Logger, poll_interval: float = 60, roots: List[Tuple[str, bool]] = ()):
+    # roots: (path, recursive) to watch. inotify is abandoned for polling when it cannot be created or when
+    # a watch cannot be added (ENOSPC once fs.inotify.max_user_watches is reached on large inboxes)
+    try:
+        watcher = InotifyWatcher()
+    except (OSError, AttributeError) as e:
+        logger.log(f"inotify not available ({e}), polling every {poll_interval} seconds")
+        return watch_roots(PollingWatcher(poll_interval), roots)
+    try:
+        watch_roots(watcher, roots)
+    except OSError as e:
+        watcher.close()
+        logger.log(f"inotify watch failed ({e}), polling every {poll_interval} seconds")
+        return watch_roots(PollingWatcher(poll_interval), roots)
+    logger.log("Watching with inotify")
+    return watcher
+
+
+def watch_roots(watcher, roots: List[Tuple[str, bool]]):
+    for path, recursive in roots:
+        watcher.watch(path, recursive)
+    return watcher